@@ -2,11 +2,14 @@
 GUD Database implementation for PostgreSQL.
 """
 # Parent DB class
-from db._database import Database
+from hashlib import sha1
+
+from db._database import Database, CUDError
 
 from src.structures.returnfields import PresetReturnField, ReturnField, EntityReturnField, MultiEntityReturnField
 
 from psycopg import sql, AsyncConnection
+from psycopg.errors import InvalidColumnReference
 from psycopg.rows import dict_row
 from psycopg.types.json import set_json_dumps, set_json_loads
 import orjson
@@ -19,20 +22,29 @@ from psycopg_pool import AsyncConnectionPool
 #### PSQL FILTER FUNCTIONS ####
 ###############################
 # Filtering agains NULL/empty values needs special logic pepehands
-def EQUALS(table, field, value):
+# Filter values are never inlined, every filter leaves a placeholder to be bound per request.
+# See PSQL.FILTER_BINDINGS for the values each placeholder expects.
+# resolved holds whatever Railgun figured out about the filtered field from STELLAR, see Railgun._resolve_filters
+def EQUALS(table, field, value, resolved=None):
     if value is not None:
-        if type(value)==str:
-            value = value.replace("%", "%%")
-        return sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" = ") + sql.Literal(value)
+        return sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" = ") + sql.Placeholder()
     else:
-        return sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" IS ") + sql.Literal(value)
-def NOT_EQUALS(table, field, value):
+        return sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" IS NULL")
+def NOT_EQUALS(table, field, value, resolved=None):
     if value is not None:
-        if type(value)==str:
-            value = value.replace("%", "%%")
-        return sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" != ") + sql.Literal(value)
+        return sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" != ") + sql.Placeholder()
     else:
-        return sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" IS NOT ") + sql.Literal(value)
+        return sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" IS NOT NULL")
+def MATCHES(table, field, value, resolved=None):
+    return sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" @@ ") + _build_tsquery(resolved)
+def _BIND_NULLABLE(value):
+    # NULL checks are compiled into the statement itself, nothing to bind
+    return () if value is None else (value,)
+def _BIND_AS_IS(value):
+    return (value,)
+def _ESCAPE_LIKE(value):
+    # Filter values are matched literally, LIKE wildcards included
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
 
 
 ##########################
@@ -48,6 +60,39 @@ class PSQL(Database):
     DEFAULT_MAX_POOL_SIZE = 20
     DEFAULT_MAX_QUEUE_SIZE = 0  # No limit
     DEFAULT_MAX_LIFETIME = 3600
+    DEFAULT_PREPARE_THRESHOLD = 5  # psycopg default, None disables prepared statements (pgbouncer)
+    DEFAULT_PREPARED_MAX = 100
+    DEFAULT_STREAM_CHUNK_SIZE = 1000
+    DEFAULT_COPY_THRESHOLD = 5000  # creates of one batch group from which COPY is used, see create_many
+    MAX_PARAMETERS = 65535  # per statement, protocol limit
+    MAX_IDENTIFIER_LENGTH = 63  # bytes, Postgres cuts anything longer
+    DEFAULT_COUNT_STRATEGY = "exact"
+    DEFAULT_COUNT_CACHE_TTL = 60  # seconds
+    COUNT_STRATEGIES = ("exact", "estimate", "cached")
+    DEFAULT_REPLICA_ROUTING = "round_robin"
+    REPLICA_ROUTINGS = ("round_robin", "least_busy")
+    INDEX_METHODS = {
+        "btree": sql.SQL("btree ({field})"),
+        "hash": sql.SQL("hash ({field})"),
+        # Lets contains/starts_with/ends_with (ILIKE) use an index, needs the pg_trgm extension
+        "trigram": sql.SQL("gin ({field} gin_trgm_ops)"),
+        # For SEARCH fields, lets matches use an index
+        "fulltext": sql.SQL("gin ({field})")
+    }
+    # Field types each index method can be used on, any type if not listed
+    INDEX_METHOD_TYPES = {
+        "trigram": ("TEXT", "LIST"),
+        "fulltext": ("SEARCH",)
+    }
+    # /aggregate functions, and the field types each can be used on, any type if not listed
+    AGGREGATE_FUNCTIONS = ("count", "sum", "avg", "min", "max")
+    AGGREGATE_FUNCTION_TYPES = {
+        "sum": ("INT", "FLOAT"),
+        "avg": ("INT", "FLOAT"),
+        "min": ("INT", "FLOAT", "DATE", "TEXT", "LIST"),
+        "max": ("INT", "FLOAT", "DATE", "TEXT", "LIST")
+    }
+    DATE_BUCKETS = ("day", "week", "month", "quarter", "year")
     GENERAL_CONNECTION_KWARGS = {"autocommit": False, "row_factory": dict_row}
 
     DB_TYPE = "PSQL"
@@ -65,13 +110,28 @@ class PSQL(Database):
     FILTER_OPTIONS = {
         "is": EQUALS,
         "is_not": NOT_EQUALS,
-        "contains": lambda table, field, value: sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" ILIKE ") + sql.Literal("%%"+value+"%%"),
-        "not_contains": lambda table, field, value: sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" NOT ILIKE ") + sql.Literal("%%"+value+"%%"),
-        "starts_with": lambda table, field, value: sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" ILIKE ") + sql.Literal(value+"%%"),
-        "ends_with": lambda table, field, value: sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" ILIKE ") + sql.Literal("%%"+value),
+        "contains": lambda table, field, value, resolved=None: sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" ILIKE ") + sql.Placeholder(),
+        "not_contains": lambda table, field, value, resolved=None: sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" NOT ILIKE ") + sql.Placeholder(),
+        "starts_with": lambda table, field, value, resolved=None: sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" ILIKE ") + sql.Placeholder(),
+        "ends_with": lambda table, field, value, resolved=None: sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" ILIKE ") + sql.Placeholder(),
+        "matches": MATCHES,
         #"in": "", TODO, should be table.field = ANY([list])
-        "greater_than": lambda table, field, value: sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" > ") + sql.Literal(value),
-        "less_than": lambda table, field, value: sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" < ") + sql.Literal(value)
+        "greater_than": lambda table, field, value, resolved=None: sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" > ") + sql.Placeholder(),
+        "less_than": lambda table, field, value, resolved=None: sql.Identifier(table)+sql.SQL(".")+sql.Identifier(field) + sql.SQL(" < ") + sql.Placeholder()
+    }
+    FILTER_OPERATORS = {
+        "AND": sql.SQL(" AND "),
+        "OR": sql.SQL(" OR ")
+    }
+    # Values bound to the placeholders of each filter option, in placeholder order.
+    # Anything not listed here binds the filter value as-is.
+    FILTER_BINDINGS = {
+        "is": _BIND_NULLABLE,
+        "is_not": _BIND_NULLABLE,
+        "contains": lambda value: ("%"+_ESCAPE_LIKE(value)+"%",),
+        "not_contains": lambda value: ("%"+_ESCAPE_LIKE(value)+"%",),
+        "starts_with": lambda value: (_ESCAPE_LIKE(value)+"%",),
+        "ends_with": lambda value: ("%"+_ESCAPE_LIKE(value),),
     }
     def __init__(self, config_params):
         super().__init__()  # Blank
@@ -88,28 +148,65 @@ class PSQL(Database):
             "port": config_params.get("DB_PORT"),
         }
 
-        # Format our config params for the string that ConnectionPools expect
-        strconfig = "".join([f"{key}={value} " for key, value in _connection_info.items() if value])
         # This is the floating connection without autocommit.
-        self.pool = AsyncConnectionPool(
-            strconfig,
-            connection_class=_PSQLConnection,
-            kwargs=PSQL.GENERAL_CONNECTION_KWARGS,
-            min_size=config_params.get("min_pool_size", PSQL.DEFAULT_MIN_POOL_SIZE),
-            max_size=config_params.get("max_pool_size", PSQL.DEFAULT_MAX_POOL_SIZE),
-            open=False,  # per psycopg documentation
-            timeout=config_params.get("queue_timeout", PSQL.DEFAULT_WAIT_TIMEOUT),
-            max_waiting=config_params.get("max_queue_size", PSQL.DEFAULT_MAX_QUEUE_SIZE),
-            max_lifetime=config_params.get("keep_alive_for", PSQL.DEFAULT_MAX_LIFETIME),
-            max_idle=config_params.get("keep_idle_for", PSQL.DEFAULT_IDLE_TIMEOUT)
-        )
+        self.pool = _build_pool(_connection_info, config_params)
         execute_immediately(self.pool.open(wait=True))
         self.stage = self.pool.connection  # syntaxical sugar
 
+        # Read replicas, reads only, see stage_read. Anything not given is the same as the primary's.
+        self.replicas = []
+        for replica in config_params.get("REPLICAS", []):
+            replica_pool = _build_pool(_connection_info | {
+                "user": replica.get("DB_USER", _connection_info["user"]),
+                "password": replica.get("DB_PASSWORD", _connection_info["password"]),
+                "host": replica.get("DB_HOST", _connection_info["host"]),
+                "port": replica.get("DB_PORT", _connection_info["port"]),
+            }, config_params)
+            execute_immediately(replica_pool.open(wait=True))
+            self.replicas.append(replica_pool)
+        self.replica_routing = config_params.get("replica_routing", PSQL.DEFAULT_REPLICA_ROUTING)
+        if self.replica_routing not in PSQL.REPLICA_ROUTINGS:
+            raise ValueError("Unknown replica_routing: %s" % self.replica_routing)
+        self._next_replica = 0
+        # Seconds a caller reads from the primary after writing, replicas may be lagging behind
+        self.read_your_writes = config_params.get("read_your_writes", 0)
+
+        # How include_count is resolved when the read doesn't say, see Railgun._count
+        self.count_strategy = config_params.get("count_strategy", PSQL.DEFAULT_COUNT_STRATEGY)
+        self.count_cache_ttl = config_params.get("count_cache_ttl", PSQL.DEFAULT_COUNT_CACHE_TTL)
+        # Entities whose reads are cached in Redis, and for how long, see src.modules.railcache
+        self.read_cache = config_params.get("read_cache", {})
+        # Read limits, none by default. Reads may ask for tighter ones, never looser.
+        self.statement_timeout = config_params.get("statement_timeout")  # ms
+        self.max_read_cost = config_params.get("max_read_cost")  # query planner cost units
+        self.max_join_depth = config_params.get("max_join_depth")
+        self.max_pagination = config_params.get("max_pagination")
+        # Grouped /batch creates of at least this many records are COPY'd, see create_many
+        self.copy_threshold = config_params.get("copy_threshold", PSQL.DEFAULT_COPY_THRESHOLD)
+
 
     #####################################
     ###########  Connection  ############
     #####################################
+    def stage_read(self, primary=False):
+        """
+        Stage a connection for reading only, from a replica if there are any.
+        - round_robin: every replica in turn
+        - least_busy: the replica with the fewest connections in use or waited for
+
+        :param bool primary: read from the primary regardless, e.g. to read one's own writes
+
+        :returns: connection context manager, same as stage
+        :rtype: AsyncContextManager[_PSQLConnection]
+        """
+        if primary or not self.replicas:
+            return self.stage()
+        if self.replica_routing == "least_busy":
+            return min(self.replicas, key=_pool_load).connection()
+        self._next_replica = (self._next_replica + 1) % len(self.replicas)
+        return self.replicas[self._next_replica].connection()
+
+
     async def _run_command(self, command, params=None, return_style="multi"):
         """
         Execute a (dirty) command.
@@ -216,6 +313,34 @@ class _PSQLConnection(AsyncConnection):
         return True
 
 
+    async def create_search_field(self, table_name, field_name, source_fields, language):
+        """
+        Create a full-text search column, kept up to date by the DB itself from other text columns.
+        Validation is assumed to be done by Stellar Stellar.
+
+        :param str table_name: table to create column in
+        :param str field_name: name of column to create
+        :param list source_fields: text columns to search through
+        :param str language: text search configuration (english, french, simple...) to parse them with
+
+        :returns: true to validate creation
+        :rtype: bool
+        """
+        COMMAND = sql.SQL("""
+            ALTER TABLE {table}
+            ADD {field} TSVECTOR GENERATED ALWAYS AS (to_tsvector({language}::regconfig, {sources})) STORED
+        """).format(
+            table=sql.Identifier(table_name),
+            field=sql.Identifier(field_name),
+            language=sql.Literal(language),
+            sources=sql.SQL(" || ' ' || ").join([
+                sql.SQL("coalesce({source}, '')").format(source=sql.Identifier(source)) for source in source_fields
+            ])
+        )
+        await self.execute(COMMAND)
+        return True
+
+
     async def delete_field(self, table_name, field_name):
         """
         Drop a column from a table.
@@ -239,113 +364,837 @@ class _PSQLConnection(AsyncConnection):
         return True
 
 
-    ### DATA ###
-    async def query(self, table, fields, filters=[], pagination=0, page=1, order="uid"):
+    async def create_relation_table(self, rtable, tableA, tableB):
+        """
+        Create the relation table between two tables, if it doesn't exist yet, along with its indexes.
+        See index_relation_table.
+
+        :param str rtable: relation table to create
+        :param str tableA: the table the relation is created from
+        :param str tableB: the table the relation links to
+        """
+        COMMAND = sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {relation} (
+                {table_col} TEXT NOT NULL,
+                {fk_table} INT NOT NULL REFERENCES {table} (uid) ON DELETE CASCADE,
+                uid INT GENERATED ALWAYS AS IDENTITY,
+                {fk_ftable} INT NOT NULL REFERENCES {ftable} (uid) ON DELETE CASCADE,
+                {ftable_col} TEXT NOT NULL
+            );
+        """).format(
+            relation=sql.Identifier(rtable),
+            table_col=sql.Identifier(tableA+"_col"),
+            fk_table=sql.Identifier("fk_"+tableA),
+            table=sql.Identifier(tableA),
+            fk_ftable=sql.Identifier("fk_"+tableB),
+            ftable=sql.Identifier(tableB),
+            ftable_col=sql.Identifier(tableB+"_col")
+        )
+        await self.execute(COMMAND)  # Reminder, this is a non-standard table
+        await self.index_relation_table(rtable, tableA, tableB)
+
+
+    async def index_relation_table(self, rtable, tableA, tableB, concurrently=False):
         """
-        Run an optimized (TODO lol) guery.
+        Create the covering indexes of a relation table, one per direction, if they don't exist yet.
+        Every relation lookup (joins, filters, relation writes) goes through (fk_table, table_col) from
+        one side or the other, the foreign key rides along so joins never need to touch the table.
+
+        :param str rtable: relation table to index
+        :param str tableA: one of the related tables
+        :param str tableB: the other related table
+        :param bool concurrently: build without locking the table against writes, expects an autocommit connection
         """
-        baseGroup = sql.SQL("")  # TODO
+        for table, ftable in ((tableA, tableB), (tableB, tableA)):
+            COMMAND = sql.SQL("""
+                CREATE INDEX {concurrently} IF NOT EXISTS {index} ON {relation} ({fk_table}, {table_col}) INCLUDE ({fk_ftable})
+            """).format(
+                concurrently=sql.SQL("CONCURRENTLY") if concurrently else sql.SQL(""),
+                index=sql.Identifier(_relation_index_name(rtable, table)),
+                relation=sql.Identifier(rtable),
+                fk_table=sql.Identifier("fk_"+table),
+                table_col=sql.Identifier(table+"_col"),
+                fk_ftable=sql.Identifier("fk_"+ftable)
+            )
+            print(COMMAND.as_string(self))  # TODO log
+            try:
+                await self.execute(COMMAND)
+            except Exception:
+                if concurrently:
+                    # Failed concurrent builds leave an invalid index behind, which IF NOT EXISTS would then skip
+                    await self.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {index}").format(
+                        index=sql.Identifier(_relation_index_name(rtable, table))
+                    ))
+                raise
+
+
+    async def create_index(self, table_name, field_name, method="btree", partial=False, unique=False):
+        """
+        Build an index on a column, without locking the table against writes.
+        CONCURRENTLY can't run in a transaction, so this expects an autocommit connection.
+        A failed build leaves an invalid index behind, which gets dropped before bubbling up.
+
+        :param str table_name: table of the column
+        :param str field_name: column to index
+        :param str method: one of PSQL.INDEX_METHODS
+        :param bool partial: only index records that aren't archived
+        :param bool unique: reject duplicate values, see upsert. btree only.
 
+        :raises: NotImplementedError if the method is not recognized by the connector
+        """
+        if method not in PSQL.INDEX_METHODS:
+            raise NotImplementedError
+        if method == "trigram":
+            await self.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
         COMMAND = sql.SQL("""
-            SELECT {select}
-            {filters}
-            {group}
-            ORDER BY {table}.{order}
-            LIMIT (%s)
-            OFFSET (%s)
+            CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {index} ON {table} USING {method}
         """).format(
-            select=_build_select_chunk(fields),
-            table=sql.Identifier(table),
-            filters=_build_filters(filters, table),
-            order=sql.Identifier(order),
-            group=baseGroup
+            unique=sql.SQL("UNIQUE " if unique else ""),
+            index=sql.Identifier(_index_name(table_name, field_name)),
+            table=sql.Identifier(table_name),
+            method=PSQL.INDEX_METHODS[method].format(field=sql.Identifier(field_name))
         )
+        if partial:
+            COMMAND += sql.SQL(" WHERE NOT _ss_archived")
         print(COMMAND.as_string(self))  # TODO log
-        return await (await self.execute(COMMAND,  (pagination, (page*pagination)-pagination))).fetchall()
+        try:
+            await self.execute(COMMAND)
+        except Exception:
+            await self.drop_index(table_name, field_name)
+            raise
 
 
-    async def count(self, table, filters):
+    async def drop_index(self, table_name, field_name):
         """
-        Run an optimized (TODO lol) guery.
+        Drop the index of a column, if any. Expects an autocommit connection, see create_index.
+
+        :param str table_name: table of the column
+        :param str field_name: indexed column
         """
-        # Prep all JOINs
-        # TODO, since filters on joined tables would have an effect, but that's not in place right now.
-        baseRTJoin = sql.SQL("")
-        # baseRTJoin = _build_joins(joins, table)
-        
-        # Groups are needed in case grouping causes duplication, which increases count...
-        baseGroup = sql.SQL("")
-        # if joins:
-        #     baseGroup += sql.SQL("GROUP BY {table}.{uid}").format(
-        #         table=sql.Identifier(table),
-        #         uid=sql.Identifier("uid")
-        #     )
+        for index in (_index_name(table_name, field_name), _legacy_index_name(table_name, field_name)):
+            if index is None:
+                continue
+            COMMAND = sql.SQL("""
+                DROP INDEX CONCURRENTLY IF EXISTS {index}
+            """).format(index=sql.Identifier(index))
+            await self.execute(COMMAND)
 
-        # Prep all filters
-        baseFilter = _build_filters(filters, table)
 
+    async def index_progress(self, table_name, field_name):
+        """
+        Fetch the progress of the index currently being built on a column.
+
+        :param str table_name: table of the column
+        :param str field_name: indexed column
+
+        :returns: build phase and progress, None if the index isn't being built
+        :rtype: dict|None
+        """
         COMMAND = sql.SQL("""
-            SELECT count(*) as total_count
+            SELECT phase, blocks_done, blocks_total, tuples_done, tuples_total
+            FROM pg_stat_progress_create_index
+            WHERE relid = to_regclass(%s) AND index_relid = to_regclass(%s)
+        """)
+        return await (await self.execute(
+            COMMAND,
+            (sql.Identifier(table_name).as_string(self), sql.Identifier(_index_name(table_name, field_name)).as_string(self))
+        )).fetchone()
+
+
+    ### DATA ###
+    @property
+    def _prepare_plans(self):
+        """
+        Read plans are reused by construction, so prepare them on first use rather than waiting
+        for the threshold. Unless prepared statements are disabled for this DB altogether.
+        """
+        return self.prepare_threshold is not None
+
+
+    async def limit_statements(self, timeout):
+        """
+        Cancel any statement of the staged transaction running for longer than the timeout.
+        Only lasts until the transaction ends, the connection goes back to the pool unlimited.
+
+        :param int timeout: milliseconds
+        """
+        await self.execute("SELECT set_config('statement_timeout', %s, true)", (str(int(timeout)),))
+
+
+    def bind_filters(self, filters):
+        """
+        Extract the values of a Railgun filter set, in the order the compiled filters expect them,
+        along with the filter's shape. Two filter sets with the same shape compile to the exact same
+        SQL, so the shape is what read plans are cached on.
+
+        :param dict filters: Railgun filters
+
+        :returns: hashable filter shape and the list of values to bind
+        :rtype: tuple, list
+        """
+        params = []
+        return (_bind_filters(filters, params) if filters else None), params
+
+
+    def plan_read(self, table, fields, filters=[], order="uid", relevance=None):
+        """
+        Compile a read down to its finished SQL text. Nothing value-related is inlined, the plan can
+        be reused by any read of the same shape (see bind_filters).
+
+        :param str table: table to read from
+        :param ReturnFieldSet fields: return fields of the read
+        :param dict filters: Railgun filters, used for their shape only
+        :param str order: field to sort by
+        :param str relevance: search field to sort by relevance to its matches filter instead, OPTIONAL
+
+        :returns: compiled read plan
+        :rtype: ReadPlan
+
+        :raises ValueError: if there's no matches filter on the relevance field to rank against
+        """
+        # uid breaks ties so pages are stable, and is the second half of any keyset
+        orderBy = [sql.Identifier(table, order)]
+        if order != "uid":
+            orderBy.append(sql.Identifier(table, "uid"))
+        orderBy = sql.SQL(", ").join(orderBy)
+        pageOrderBy = orderBy
+
+        rank = sql.SQL("")
+        rank_param = None
+        if relevance:
+            # Ranked against the same search the filter matches on, computed once per record of the page
+            found = _find_match(filters, relevance, [])
+            if found is None:
+                raise ValueError("No matches filter on %s to rank by" % relevance)
+            rank_param, resolved = found
+            rank = sql.SQL(", ts_rank({field}, {query}) AS _ss_rank").format(
+                field=sql.Identifier(table, relevance),
+                query=_build_tsquery(resolved)
+            )
+            pageOrderBy = sql.SQL("_ss_rank DESC, {uid}").format(uid=sql.Identifier(table, "uid"))
+            orderBy = sql.SQL("{rank} DESC, {uid}").format(rank=sql.Identifier(table, "_ss_rank"), uid=sql.Identifier(table, "uid"))
+
+        # The page is cut before anything gets joined, linked fields are only ever fetched for it
+        QUERY = _build_select_chunk(
+            fields,
+            _build_page(table, _build_filters(filters, table), pageOrderBy, sql.SQL("LIMIT (%s) OFFSET (%s)"), rank=rank),
+            orderBy
+        )
+        # Same page, with the total count of the filters riding along on every record
+        QUERY_COUNTED = _build_select_chunk(
+            fields,
+            _build_page(table, _build_filters(filters, table), pageOrderBy, sql.SQL("LIMIT (%s) OFFSET (%s)"), counted=True, rank=rank),
+            orderBy,
+            sql.Identifier(table, "_ss_total_count")
+        )
+        SEEK = _build_select_chunk(
+            fields,
+            _build_page(table, _build_filters(filters, table, _build_seek(table, order)), pageOrderBy, sql.SQL("LIMIT (%s)"), rank=rank),
+            orderBy
+        )
+        SEEK_NULL = _build_select_chunk(
+            fields,
+            _build_page(table, _build_filters(filters, table, _build_seek(table, order, null=True)), pageOrderBy, sql.SQL("LIMIT (%s)"), rank=rank),
+            orderBy
+        )
+        STREAM = _build_select_chunk(
+            fields,
+            _build_page(table, _build_filters(filters, table), pageOrderBy, rank=rank),
+            orderBy
+        )
+
+        ESTIMATE = sql.SQL("EXPLAIN (FORMAT JSON) SELECT 1 FROM {table} {filters}").format(
+            table=sql.Identifier(table),
+            filters=_build_filters(filters, table)
+        )
+
+        plan = ReadPlan(
+            query=QUERY.as_string(self),
+            query_counted=QUERY_COUNTED.as_string(self),
+            count=_build_count(table, filters).as_string(self),
+            estimate=ESTIMATE.as_string(self),
+            seek=SEEK.as_string(self),
+            seek_null=SEEK_NULL.as_string(self),
+            stream=STREAM.as_string(self),
+            query_json=_build_json_rows(QUERY).as_string(self),
+            query_counted_json=_build_json_rows(QUERY_COUNTED, counted=fields).as_string(self),
+            seek_json=_build_json_rows(SEEK).as_string(self),
+            seek_null_json=_build_json_rows(SEEK_NULL).as_string(self),
+            stream_json=_build_json_rows(STREAM).as_string(self),
+            order=order,
+            tables=frozenset(_read_tables(fields, _filter_tables(filters, {table}))),
+            rank=rank_param
+        )
+        print(plan.query)  # TODO log
+        return plan
+
+
+    def plan_aggregate(self, table, groups, aggregates, filters=[]):
+        """
+        Compile an aggregation down to a single GROUP BY query, see plan_read.
+        Groups on linked fields are LEFT JOINed through their relations, records without a link
+        are grouped under NULL. Only single-entity links are expected, anything else would count
+        records once per link.
+
+        Expects groups and aggregates resolved by Railgun:
+        groups: [{"field": <field on the last linked entity>, "links": [<link>], "bucket": <DATE_BUCKETS>|None}]
+        aggregates: [{"function": <AGGREGATE_FUNCTIONS>, "field": <field>|None, "type": <field type>|None}]
+        See _build_exists for the link format.
+
+        :param str table: table to aggregate
+        :param list groups: fields to group by
+        :param list aggregates: values to compute for each group
+        :param dict filters: Railgun filters, used for their shape only
+
+        :returns: compiled aggregation, with every group as _ss_g<index> and every aggregate as _ss_a<index>
+        :rtype: str
+        """
+        selects = []
+        joins = []
+        for i, group in enumerate(groups):
+            local = table
+            for depth, link in enumerate(group["links"]):
+                relation = "_ss_g%s_r%s" % (i, depth)
+                ftable = "_ss_g%s_f%s" % (i, depth)
+                joins.append(sql.SQL("""
+                    LEFT JOIN {rtable} {relation} ON {relation}.{fk_table} = {local}.uid AND {relation}.{table_col} = {col}
+                    LEFT JOIN {ftable_name} {ftable} ON {relation}.{fk_ftable} = {ftable}.uid""").format(
+                    rtable=sql.Identifier(link["relation"]),
+                    relation=sql.Identifier(relation),
+                    fk_table=sql.Identifier("fk_"+link["table"]),
+                    local=sql.Identifier(local),
+                    table_col=sql.Identifier(link["table"]+"_col"),
+                    col=sql.Literal(link["col"]),
+                    ftable_name=sql.Identifier(link["ftable"]),
+                    ftable=sql.Identifier(ftable),
+                    fk_ftable=sql.Identifier("fk_"+link["ftable"])
+                ))
+                local = ftable
+            value = sql.Identifier(local, group["field"])
+            if group.get("bucket"):
+                value = sql.SQL("date_trunc({bucket}, {value})::date").format(bucket=sql.Literal(group["bucket"]), value=value)
+            selects.append(sql.SQL("{value} AS {alias}").format(value=value, alias=sql.Identifier("_ss_g%s" % i)))
+
+        for i, aggregate in enumerate(aggregates):
+            if aggregate.get("field"):
+                value = sql.SQL("{function}({field})").format(
+                    function=sql.SQL(aggregate["function"]),
+                    field=sql.Identifier(table, aggregate["field"])
+                )
+            else:
+                value = sql.SQL("count(*)")
+            # Keep numbers JSON friendly, PSQL would return NUMERIC
+            if aggregate["function"] == "avg":
+                value += sql.SQL("::double precision")
+            elif aggregate["function"] == "sum" and aggregate.get("type") == "INT":
+                value += sql.SQL("::bigint")
+            selects.append(sql.SQL("{value} AS {alias}").format(value=value, alias=sql.Identifier("_ss_a%s" % i)))
+
+        positions = sql.SQL(", ").join([sql.Literal(i+1) for i in range(len(groups))])
+        return sql.SQL("""
+            SELECT {selects}
             FROM {table}
             {joins}
             {filters}
             {group}
         """).format(
+            selects=sql.SQL(", ").join(selects),
             table=sql.Identifier(table),
-            joins=baseRTJoin,
-            filters=baseFilter,
-            group=baseGroup
-        )
-        print(COMMAND.as_string(self))  # TODO log
-        return await (await self.execute(COMMAND)).fetchone()
+            joins=sql.SQL("").join(joins),
+            filters=_build_filters(filters, table),
+            group=sql.SQL("GROUP BY {positions} ORDER BY {positions}").format(positions=positions) if groups else sql.SQL("")
+        ).as_string(self)
+
+
+    def plan_facets(self, table, facets, filters=[]):
+        """
+        Compile the counts of every distinct value of several fields down to a single GROUPING SETS
+        query, so the table is only scanned once, see plan_read.
+        Entity fields are LEFT JOINed through the relation of each entity type they can link to,
+        and grouped by the linked record's uid and display name. Records without a link are counted
+        under NULL. Only single-entity fields are expected, anything else would skew every count.
+
+        Expects facets resolved by Railgun:
+        [{"field": <field>, "targets": [<link>, etc...]}]
+        where targets are empty for non-entity fields. See _build_exists for the link format,
+        along with the linked entity's "display" field.
+
+        :param str table: table to count
+        :param list facets: fields to count the values of
+        :param dict filters: Railgun filters, used for their shape only
+
+        :returns: compiled facets. Every row is the count (_ss_count) of a single value of a single
+                  facet, _ss_in<index> is 0 for the facet it belongs to. Its value is in _ss_f<index>,
+                  or _ss_f<index>_<target>_uid/_display for entity fields.
+        :rtype: str
+        """
+        selects = []
+        joins = []
+        sets = []
+        for i, facet in enumerate(facets):
+            columns = []
+            if not facet["targets"]:
+                columns.append(sql.SQL("{value} AS {alias}").format(
+                    value=sql.Identifier(table, facet["field"]),
+                    alias=sql.Identifier("_ss_f%s" % i)
+                ))
+            for k, link in enumerate(facet["targets"]):
+                relation = "_ss_f%s_r%s" % (i, k)
+                ftable = "_ss_f%s_f%s" % (i, k)
+                joins.append(sql.SQL("""
+                    LEFT JOIN {rtable} {relation} ON {relation}.{fk_table} = {table}.uid AND {relation}.{table_col} = {col}
+                    LEFT JOIN {ftable_name} {ftable} ON {relation}.{fk_ftable} = {ftable}.uid""").format(
+                    rtable=sql.Identifier(link["relation"]),
+                    relation=sql.Identifier(relation),
+                    fk_table=sql.Identifier("fk_"+link["table"]),
+                    table=sql.Identifier(table),
+                    table_col=sql.Identifier(link["table"]+"_col"),
+                    col=sql.Literal(link["col"]),
+                    ftable_name=sql.Identifier(link["ftable"]),
+                    ftable=sql.Identifier(ftable),
+                    fk_ftable=sql.Identifier("fk_"+link["ftable"])
+                ))
+                columns.append(sql.SQL("{uid} AS {alias}").format(
+                    uid=sql.Identifier(ftable, "uid"),
+                    alias=sql.Identifier("_ss_f%s_%s_uid" % (i, k))
+                ))
+                columns.append(sql.SQL("{display} AS {alias}").format(
+                    display=sql.Identifier(ftable, link["display"]),
+                    alias=sql.Identifier("_ss_f%s_%s_display" % (i, k))
+                ))
+            selects.extend(columns)
+            # Every facet has its own grouping set, GROUPING tells which one a row belongs to
+            selects.append(sql.SQL("GROUPING({positions}) AS {alias}").format(
+                positions=sql.SQL(", ").join([sql.Identifier(table, facet["field"])] if not facet["targets"] else [
+                    sql.Identifier("_ss_f%s_f%s" % (i, k), "uid") for k in range(len(facet["targets"]))
+                ]),
+                alias=sql.Identifier("_ss_in%s" % i)
+            ))
+            sets.append(sql.SQL("({columns})").format(
+                columns=sql.SQL(", ").join([sql.Identifier(table, facet["field"])] if not facet["targets"] else [
+                    column for k, link in enumerate(facet["targets"]) for column in (
+                        sql.Identifier("_ss_f%s_f%s" % (i, k), "uid"),
+                        sql.Identifier("_ss_f%s_f%s" % (i, k), link["display"])
+                    )
+                ])
+            ))
+
+        return sql.SQL("""
+            SELECT {selects}, count(*) AS _ss_count
+            FROM {table}
+            {joins}
+            {filters}
+            GROUP BY GROUPING SETS ({sets})
+        """).format(
+            selects=sql.SQL(", ").join(selects),
+            table=sql.Identifier(table),
+            joins=sql.SQL("").join(joins),
+            filters=_build_filters(filters, table),
+            sets=sql.SQL(", ").join(sets)
+        ).as_string(self)
+
+
+    async def aggregate_plan(self, plan, params):
+        """
+        Run a compiled aggregation, or facets.
+
+        :param str plan: compiled aggregation, see plan_aggregate and plan_facets
+        :param list params: bound filter values, see bind_filters
+
+        :returns: a row per group
+        :rtype: list[dict]
+        """
+        return await (await self.execute(plan, params, prepare=self._prepare_plans)).fetchall()
+
+
+    async def query(self, table, fields, filters=[], pagination=0, page=1, order="uid"):
+        """
+        Run a one-off query. Anything called repeatedly should keep its plan and use query_plan.
+        """
+        _, params = self.bind_filters(filters)
+        return await self.query_plan(self.plan_read(table, fields, filters, order), params, pagination, page)
+
+
+    async def query_plan(self, plan, params, pagination=0, page=1, raw=False):
+        """
+        Run a compiled read plan.
+
+        :param ReadPlan plan: compiled read
+        :param list params: bound filter values, see bind_filters
+        :param int pagination: entries per page
+        :param int page: page to fetch
+        :param bool raw: fetch every record as its JSON text instead, nothing gets parsed
+
+        :returns: fetched records
+        :rtype: list[dict]|list[str]
+        """
+        records = await (await self.execute(
+            plan.query_json if raw else plan.query,
+            (*plan.ranked(params), pagination, (page*pagination)-pagination),
+            prepare=self._prepare_plans
+        )).fetchall()
+        return [record["_ss_json"] for record in records] if raw else records
+
+
+    async def query_count_plan(self, plan, params, pagination=0, page=1, raw=False):
+        """
+        Run a compiled read plan, counting every record matching its filters in the same statement.
+
+        :param ReadPlan plan: compiled read
+        :param list params: bound filter values, see bind_filters
+        :param int pagination: entries per page
+        :param int page: page to fetch
+        :param bool raw: fetch every record as its JSON text instead, nothing gets parsed
+
+        :returns: fetched records and {"total_count": <int>}
+        :rtype: list[dict]|list[str], dict
+        """
+        records = await (await self.execute(
+            plan.query_counted_json if raw else plan.query_counted,
+            (*plan.ranked(params), pagination, (page*pagination)-pagination),
+            prepare=self._prepare_plans
+        )).fetchall()
+        if not records:
+            # Past the last page, nothing carried the count back
+            return records, await self.count_plan(plan, params)
+        if raw:
+            return [record["_ss_json"] for record in records], {"total_count": records[0]["_ss_total_count"]}
+        for record in records:
+            total_count = record.pop("_ss_total_count")
+        return records, {"total_count": total_count}
+
+
+    async def seek_plan(self, plan, params, keyset, pagination=0, raw=False):
+        """
+        Run a compiled read plan from a keyset rather than an offset. Only the rows after the
+        keyset are ever scanned, so deep pages cost the same as the first.
+
+        :param ReadPlan plan: compiled read
+        :param list params: bound filter values, see bind_filters
+        :param tuple keyset: (order value, uid) of the last record of the previous page
+        :param int pagination: entries per page
+        :param bool raw: fetch every record as its JSON text instead, nothing gets parsed
+
+        :returns: fetched records
+        :rtype: list[dict]|list[str]
+        """
+        order_value, uid = keyset
+        if order_value is None:
+            # Only NULLs left to page through, see _build_seek
+            query, seek = (plan.seek_null_json if raw else plan.seek_null), (uid,)
+        elif plan.order == "uid":
+            # uid is the whole keyset
+            query, seek = (plan.seek_json if raw else plan.seek), (uid,)
+        else:
+            query, seek = (plan.seek_json if raw else plan.seek), (order_value, uid)
+        records = await (await self.execute(
+            query,
+            (*plan.ranked(params), *seek, pagination),
+            prepare=self._prepare_plans
+        )).fetchall()
+        return [record["_ss_json"] for record in records] if raw else records
+
+
+    async def stream_plan(self, plan, params, chunk_size=PSQL.DEFAULT_STREAM_CHUNK_SIZE, raw=False):
+        """
+        Run a compiled read plan without pagination through a named server-side cursor,
+        yielding the results a chunk at a time. Only one chunk is ever held in memory.
+        Must be consumed within the staged transaction, the cursor dies with it.
+
+        :param ReadPlan plan: compiled read
+        :param list params: bound filter values, see bind_filters
+        :param int chunk_size: records fetched per round trip
+        :param bool raw: fetch every record as its JSON text instead, nothing gets parsed
+
+        :returns: chunks of fetched records
+        :rtype: AsyncGenerator[list[dict]]|AsyncGenerator[list[str]]
+        """
+        async with self.cursor(name="_ss_stream") as cur:
+            await cur.execute(plan.stream_json if raw else plan.stream, plan.ranked(params))
+            while records := await cur.fetchmany(chunk_size):
+                yield [record["_ss_json"] for record in records] if raw else records
+
+
+    async def explain_plan(self, plan, params, pagination=0, page=1):
+        """
+        Ask the query planner how it would run a compiled read plan, without running it.
 
+        :param ReadPlan plan: compiled read
+        :param list params: bound filter values, see bind_filters
+        :param int pagination: entries per page
+        :param int page: page to explain
 
-    async def create(self, op):
+        :returns: {"plan": <planner output>, "seq_scans": [<every sequential scan in the plan>]}
+        :rtype: dict
+        """
+        explained = await (await self.execute(
+            "EXPLAIN (FORMAT JSON) " + plan.query,
+            (*plan.ranked(params), pagination, (page*pagination)-pagination)
+        )).fetchone()
+        return {
+            "plan": explained["QUERY PLAN"][0]["Plan"],
+            "seq_scans": _find_seq_scans(explained["QUERY PLAN"][0]["Plan"], [])
+        }
+
+
+    async def cost_plan(self, plan, params, pagination=None, page=1):
+        """
+        Ask the query planner how expensive a compiled read plan would be, without running it.
+
+        :param ReadPlan plan: compiled read
+        :param list params: bound filter values, see bind_filters
+        :param int pagination: entries per page, None for the unpaginated stream
+        :param int page: page to cost
+
+        :returns: total estimated cost, in the planner's arbitrary units
+        :rtype: float
+        """
+        if pagination is None:
+            explained = await (await self.execute("EXPLAIN (FORMAT JSON) " + plan.stream, plan.ranked(params))).fetchone()
+        else:
+            explained = await (await self.execute(
+                "EXPLAIN (FORMAT JSON) " + plan.query,
+                (*plan.ranked(params), pagination, (page*pagination)-pagination)
+            )).fetchone()
+        return explained["QUERY PLAN"][0]["Plan"]["Total Cost"]
+
+
+    async def count(self, table, filters):
+        """
+        Count the records matching a one-off set of filters.
+        """
+        _, params = self.bind_filters(filters)
+        return await (await self.execute(_build_count(table, filters), params)).fetchone()
+
+
+    async def count_plan(self, plan, params):
+        """
+        Count the records matching a compiled read plan, regardless of pagination.
+
+        :param ReadPlan plan: compiled read
+        :param list params: bound filter values, see bind_filters
+
+        :returns: {"total_count": <int>}
+        :rtype: dict
+        """
+        return await (await self.execute(plan.count, params, prepare=self._prepare_plans)).fetchone()
+
+
+    async def estimate_plan(self, plan, params):
+        """
+        Estimate the number of records matching a compiled read plan from the query planner's
+        statistics, without scanning anything. Only as good as the table's last ANALYZE.
+
+        :param ReadPlan plan: compiled read
+        :param list params: bound filter values, see bind_filters
+
+        :returns: {"total_count": <int>, "estimated": True}
+        :rtype: dict
+        """
+        explained = await (await self.execute(plan.estimate, params)).fetchone()
+        return {"total_count": explained["QUERY PLAN"][0]["Plan"]["Plan Rows"], "estimated": True}
+
+
+    async def create(self, op, deferred=False):
         """
         Create a record of a certain type, using column values found in the requested operation.
         Relations are handled by Railgun.
 
         :param dict op: insert operation to perform
-        :param sql.Connection conn: active psycopg connection
+        :param bool deferred: return the cursor without fetching, see Railgun.batch
 
         :returns: type-uid dict of the created record
-        :rtype: dict
+        :rtype: dict|psycopg.AsyncCursor
+        """
+        COMMAND = sql.SQL("INSERT INTO {table} ({fields}) VALUES ({values}) RETURNING {nicetype} as type, uid").format(
+            table=sql.Identifier(op["table"]),
+            fields=sql.SQL(", ").join([sql.Identifier(field) for field in op["data"].keys()]),
+            values=sql.SQL(", ").join([sql.Placeholder() for _ in op["data"]]),
+            nicetype=sql.Literal(op["entity"])
+        )
+        print(COMMAND.as_string(self))
+        cursor = await self.execute(COMMAND, tuple(op["data"].values()))
+        # In pipeline mode, fetching waits for the DB to catch up
+        return cursor if deferred else await cursor.fetchone()
+
+
+    async def upsert(self, op, conflict, partial=False, deferred=False):
+        """
+        Create a record of a certain type, or update the one with the same value on a unique field.
+        Relations are handled by Railgun.
+
+        :param dict op: upsert operation to perform
+        :param str conflict: unique field identifying the record, must be in op["data"]
+        :param bool partial: if the unique index only covers unarchived records
+        :param bool deferred: return the cursor without fetching, see Railgun.batch
+
+        :returns: type-uid dict of the created or updated record
+        :rtype: dict|psycopg.AsyncCursor
+
+        :raises CUDError: if conflict has no unique index in the DB, despite being recorded as having one.
+                          Deferred, this only comes up as InvalidColumnReference once the batch is fetched.
         """
-        # TODO secure this, params is not safe
-        params = ", ".join("(%s)" for _ in op['data'].values())
-        COMMAND = sql.SQL("INSERT INTO {table} ({fields}) VALUES ("+params+") RETURNING {nicetype} as type, uid").format(
+        # Something has to be SET for the existing record to be RETURNed
+        updated = [field for field in op["data"] if field != conflict] or [conflict]
+        COMMAND = sql.SQL("""
+            INSERT INTO {table} ({fields}) VALUES ({values})
+            ON CONFLICT ({conflict}) {predicate}
+            DO UPDATE SET {vupdate}
+            RETURNING {nicetype} as type, uid
+        """).format(
             table=sql.Identifier(op["table"]),
             fields=sql.SQL(", ").join([sql.Identifier(field) for field in op["data"].keys()]),
+            values=sql.SQL(", ").join([sql.Placeholder() for _ in op["data"]]),
+            conflict=sql.Identifier(conflict),
+            # Has to match the index's own predicate for Postgres to pick it
+            predicate=sql.SQL("WHERE NOT _ss_archived" if partial else ""),
+            vupdate=sql.SQL(", ").join([sql.SQL("{key} = EXCLUDED.{key}").format(key=sql.Identifier(key)) for key in updated]),
             nicetype=sql.Literal(op["entity"])
         )
         print(COMMAND.as_string(self))
-        return await (await self.execute(COMMAND, tuple(op["data"].values()))).fetchone()
+        try:
+            cursor = await self.execute(COMMAND, tuple(op["data"].values()))
+            # In pipeline mode, fetching waits for the DB to catch up
+            return cursor if deferred else await cursor.fetchone()
+        except InvalidColumnReference as e:
+            # No unique index matching ON CONFLICT, it was dropped or never finished building
+            raise CUDError("No unique index on %s to upsert on: %s" % (conflict, e))
 
 
-    async def update(self, op):
+    async def create_many(self, table, entity, fields, rows, copy=False):
+        """
+        Create records of a certain type in one go, every record setting the same columns.
+        Relations are handled by Railgun.
+
+        Rows are sent as multi-row INSERTs, as many per statement as the parameter limit allows,
+        or COPY'd into a staging table and inserted from there when copy is set.
+
+        :param str table: table to insert in to
+        :param str entity: entity name of the table
+        :param list[str] fields: columns set by every record
+        :param list[tuple] rows: values of every record, in the same order as fields
+        :param bool copy: go through COPY, faster on very large groups
+
+        :returns: type-uid dicts of the created records, in the same order as rows
+        :rtype: list[dict]
+        """
+        columns = sql.SQL(", ").join([sql.Identifier(field) for field in fields])
+        if copy:
+            created = await self._copy_create(table, entity, columns, rows)
+        else:
+            created = []
+            row_values = sql.SQL("({values})").format(values=sql.SQL(", ").join([sql.Placeholder() for _ in fields]))
+            per_statement = max(1, PSQL.MAX_PARAMETERS // len(fields))
+            for start in range(0, len(rows), per_statement):
+                chunk = rows[start:start+per_statement]
+                COMMAND = sql.SQL("INSERT INTO {table} ({fields}) VALUES {values} RETURNING {nicetype} as type, uid").format(
+                    table=sql.Identifier(table),
+                    fields=columns,
+                    values=sql.SQL(", ").join([row_values] * len(chunk)),
+                    nicetype=sql.Literal(entity)
+                )
+                # Never worth preparing, the text changes with the size of the chunk
+                created += await (await self.execute(COMMAND, [value for row in chunk for value in row], prepare=False)).fetchall()
+        # uids are handed out by the identity in insertion order, which is the order of rows.
+        # Postgres doesn't promise RETURNING follows it, so don't rely on it.
+        return sorted(created, key=lambda record: record["uid"])
+
+
+    async def _copy_create(self, table, entity, columns, rows):
+        """
+        COPY rows into a temporary staging table, then INSERT them from there in their original order.
+        See create_many.
+
+        :returns: type-uid dicts of the created records, unordered
+        :rtype: list[dict]
+        """
+        stage = sql.Identifier("_ss_stage_" + table)
+        await self.execute(sql.SQL("""
+            CREATE TEMPORARY TABLE {stage} ON COMMIT DROP AS
+            SELECT 0::bigint AS _ss_ord, {fields} FROM {table} WITH NO DATA
+        """).format(stage=stage, fields=columns, table=sql.Identifier(table)))
+        async with self.cursor() as cursor:
+            async with cursor.copy(sql.SQL("COPY {stage} (_ss_ord, {fields}) FROM STDIN").format(stage=stage, fields=columns)) as copy:
+                for ordinal, row in enumerate(rows):
+                    await copy.write_row((ordinal, *row))
+        COMMAND = sql.SQL("""
+            INSERT INTO {table} ({fields})
+            SELECT {fields} FROM {stage} ORDER BY _ss_ord
+            RETURNING {nicetype} as type, uid
+        """).format(
+            table=sql.Identifier(table),
+            fields=columns,
+            stage=stage,
+            nicetype=sql.Literal(entity)
+        )
+        print(COMMAND.as_string(self))
+        created = await (await self.execute(COMMAND)).fetchall()
+        # Another group of the same batch may need it again
+        await self.execute(sql.SQL("DROP TABLE {stage}").format(stage=stage))
+        return created
+
+
+    async def update(self, op, deferred=False):
         """
         Update a record of a certain type, using column values found in the requested operation.
         Relations are handled by Railgun.
 
         :param dict op: update operation to perform
-        :param sql.Connection conn: active psycopg connection
+        :param bool deferred: return the cursor without fetching, see Railgun.batch
 
         :returns: type-uid dict of the updated record
-        :rtype: dict
+        :rtype: dict|psycopg.AsyncCursor
         """
         COMMAND = sql.SQL("""
             UPDATE {table}
             SET {vupdate}
-            WHERE uid = {uid}
+            WHERE uid = %s
             RETURNING {nicetype} as type, uid
         """).format(
             table=sql.Identifier(op["table"]),
-            vupdate=sql.SQL(", ").join([sql.SQL("{key} = {value}").format(key=sql.Identifier(key), value=sql.Literal(value)) for key, value in op["data"].items()]),
-            uid=sql.Literal(op["entity_id"]),
+            vupdate=sql.SQL(", ").join([sql.SQL("{key} = %s").format(key=sql.Identifier(key)) for key in op["data"].keys()]),
             nicetype=sql.Literal(op["entity"])
         )
         print(COMMAND.as_string(self))
-        return await (await self.execute(COMMAND)).fetchone()
+        cursor = await self.execute(COMMAND, (*op["data"].values(), op["entity_id"]))
+        # In pipeline mode, fetching waits for the DB to catch up
+        return cursor if deferred else await cursor.fetchone()
+
+
+    async def update_where(self, table, entity, data, filters, params, count_only=False):
+        """
+        Update every record matching a set of filters with the same column values, in one statement.
+        Relations are not supported, only plain columns.
+
+        :param str table: table to update
+        :param str entity: entity name of the table
+        :param dict data: column values to set
+        :param dict filters: Railgun filters, resolved
+        :param list params: bound filter values, see bind_filters
+        :param bool count_only: only return how many records were updated
+
+        :returns: type-uid dicts of the updated records, or {"type": <entity>, "count": <int>}
+        :rtype: list[dict]|dict
+        """
+        COMMAND = sql.SQL("""
+            UPDATE {table}
+            SET {vupdate}
+            {filters}
+            RETURNING {nicetype} as type, uid
+        """).format(
+            table=sql.Identifier(table),
+            vupdate=sql.SQL(", ").join([sql.SQL("{key} = %s").format(key=sql.Identifier(key)) for key in data.keys()]),
+            filters=_build_filters(filters, table),
+            nicetype=sql.Literal(entity)
+        )
+        if count_only:
+            COMMAND = sql.SQL("WITH _ss_updated AS ({update}) SELECT {nicetype} as type, count(*) AS count FROM _ss_updated").format(
+                update=COMMAND,
+                nicetype=sql.Literal(entity)
+            )
+        print(COMMAND.as_string(self))
+        cursor = await self.execute(COMMAND, (*data.values(), *params))
+        return await cursor.fetchone() if count_only else await cursor.fetchall()
 
 
     async def delete(self, op):
@@ -360,57 +1209,109 @@ class _PSQLConnection(AsyncConnection):
         :rtype: dict
         """
         COMMAND = sql.SQL(
-            "DELETE FROM {table} WHERE uid={uid}"
+            "DELETE FROM {table} WHERE uid = %s"
         ).format(
-            table=sql.Identifier(op["table"]),
-            uid=sql.Literal(op["entity_id"])
+            table=sql.Identifier(op["table"])
         )
         print(COMMAND.as_string(self))
-        await self.execute(COMMAND)
+        await self.execute(COMMAND, (op["entity_id"],))
         return {"type": op["entity"], "uid": op["entity_id"]}
 
 
-    async def delete_relation(self, rtable, tableA, s_col, s_uid):
+    async def delete_relations(self, rtable, tableA, s_col, s_uids):
         """
-        Removes all relations between table A and table B for a specific column and foreign key.
-        Managing diffs would be a massive pain compared to how simple it is to just wipe and reset
-        every time, from a DB standpoint.
+        Removes all relations between table A and table B for a specific column and set of foreign keys.
 
-        DELETE FROM _ss_table_table WHERE table_col = {col} AND fk_table = {uid};
+        DELETE FROM _ss_table_table WHERE table_col = {col} AND fk_table = ANY({uids});
 
         :param str rtable: relation table between tableA and tableB
-        :param str tableA: the table of the foreign key to be removed.
+        :param str tableA: the table of the foreign keys to be removed.
         :param str s_col: the field code that is getting cleared
-        :param str s_uid: the foreign key to be removed
+        :param list[int] s_uids: the foreign keys to be removed
         :param psycopg.Connection conn: DB connection
         """
         COMMAND = sql.SQL("""
-            DELETE FROM {rtable} WHERE {tableA_col} = {s_col} AND {fk_tableA} = {s_uid}
+            DELETE FROM {rtable} WHERE {tableA_col} = %s AND {fk_tableA} = ANY(%s::int[])
+        """).format(
+            rtable=sql.Identifier(rtable),
+            tableA_col=sql.Identifier(tableA+"_col"),
+            fk_tableA=sql.Identifier("fk_"+tableA)
+        )
+        print(COMMAND.as_string(self))
+        await self.execute(COMMAND, (s_col, s_uids))
+
+
+    async def read_relations(self, rtable, tableA, tableB, tableA_col, s_uid):
+        """
+        Fetch the records a record is currently related to on a specific column.
+
+        SELECT fk_table FROM _ss_table_table WHERE table_col = {col} AND fk_table = {uid};
+
+        :param str rtable: relation table between tableA and tableB
+        :param str tableA: the table referring to the entity being modified
+        :param str tableB: the table referring to the entities linked to
+        :param str tableA_col: the field code of tableA
+        :param int s_uid: uid of the record being modified
+
+        :returns: uids of the tableB records related
+        :rtype: list[int]
+        """
+        COMMAND = sql.SQL("""
+            SELECT {fk_tableB} AS uid FROM {rtable} WHERE {tableA_col} = %s AND {fk_tableA} = %s
         """).format(
             rtable=sql.Identifier(rtable),
             tableA_col=sql.Identifier(tableA+"_col"),
-            s_col=sql.Literal(s_col),
             fk_tableA=sql.Identifier("fk_"+tableA),
-            s_uid=sql.Literal(s_uid)
+            fk_tableB=sql.Identifier("fk_"+tableB)
+        )
+        return [row["uid"] for row in await (await self.execute(COMMAND, (tableA_col, s_uid))).fetchall()]
+
+
+    async def remove_relations(self, rtable, tableA, tableB, tableA_col, s_uid, f_uids):
+        """
+        Remove specific relations of a record on a specific column, leaving the rest of them be.
+
+        DELETE FROM _ss_table_table WHERE table_col = {col} AND fk_table = {uid} AND fk_table = ANY({uids});
+
+        :param str rtable: relation table between tableA and tableB
+        :param str tableA: the table referring to the entity being modified
+        :param str tableB: the table referring to the entities to unlink
+        :param str tableA_col: the field code of tableA
+        :param int s_uid: uid of the record being modified
+        :param list[int] f_uids: uids of the tableB records to unlink
+        """
+        COMMAND = sql.SQL("""
+            DELETE FROM {rtable} WHERE {tableA_col} = %s AND {fk_tableA} = %s AND {fk_tableB} = ANY(%s::int[])
+        """).format(
+            rtable=sql.Identifier(rtable),
+            tableA_col=sql.Identifier(tableA+"_col"),
+            fk_tableA=sql.Identifier("fk_"+tableA),
+            fk_tableB=sql.Identifier("fk_"+tableB)
         )
         print(COMMAND.as_string(self))
-        await self.execute(COMMAND)
+        await self.execute(COMMAND, (tableA_col, s_uid, f_uids))
 
 
-    async def create_relation(self, rtable, tableA, tableB, values):
+    async def create_relations(self, rtable, tableA, tableB, tableA_col, s_uid, tableB_col, f_uids):
         """
-        Create a relation between two records on a specific column.
+        Create the relations between a record and a set of others on a specific column, in one go.
         All relations are standardized by Stellar Stellar, thankfully.
 
-        INSERT INTO _ss_table_table (table_col, fk_table, fk_table, table_col)
+        INSERT INTO _ss_table_table (table_col, fk_table, fk_table, table_col) SELECT ... FROM unnest({uids})
 
         :param str rtable: relation table to insert in to
         :param str tableA: the table referring to the entity we are modifying
-        :param str tableB: the table referring to the entity we are linking to
-        :param tuple values: the values to insert - (tableA_col, fk_tableA, fk_tableB, tableB_col)
+        :param str tableB: the table referring to the entities we are linking to
+        :param str tableA_col: the field code of tableA being set
+        :param int s_uid: uid of the record being modified
+        :param str tableB_col: the field code of tableB on the other side of the relation
+        :param list[int] f_uids: uids of the records to link to, in order
         """
         COMMAND = sql.SQL("""
-            INSERT INTO {rtable} ({tableA_col}, {fk_tableA}, {fk_tableB}, {tableB_col}) VALUES ((%s), (%s), (%s), (%s))
+            INSERT INTO {rtable} ({tableA_col}, {fk_tableA}, {fk_tableB}, {tableB_col})
+            SELECT %s, %s, _ss_link.fk, %s
+            FROM unnest(%s::int[]) WITH ORDINALITY AS _ss_link(fk, ord)
+            ORDER BY _ss_link.ord
         """).format(
             rtable=sql.Identifier(rtable),
             tableA_col=sql.Identifier(tableA+"_col"),
@@ -419,49 +1320,317 @@ class _PSQLConnection(AsyncConnection):
             tableB_col=sql.Identifier(tableB+"_col")
         )
         print(COMMAND.as_string(self))
-        await self.execute(COMMAND, values)
+        await self.execute(COMMAND, (tableA_col, s_uid, tableB_col, f_uids))
+
 
 
 
+class ReadPlan():
+    """
+    Finished SQL text of a read, with every filter value left as a placeholder.
+    Built once per read shape by _PSQLConnection.plan_read, values are bound per request.
+    - query: paginated SELECT, expects the filter values then LIMIT and OFFSET
+    - query_counted: same as query, with every record carrying the total count as _ss_total_count
+    - count: COUNT of the same filters, expects the filter values
+    - estimate: EXPLAIN of the same filters, expects the filter values
+    - seek: keyset paginated SELECT, expects the filter values, the last order value and uid, then LIMIT
+    - seek_null: same as seek once the order values left are all NULL, expects the filter values, uid then LIMIT
+    - stream: unpaginated SELECT, expects the filter values
+    - *_json: same as their namesake, with every record as the JSON text of its fields in _ss_json
+      (query_counted_json keeps _ss_total_count alongside, out of the JSON), see _build_json_rows
+    - order: field the read is sorted by
+    - tables: every table the read touches, anything read is stale once any of them is written to
+    - rank: when sorted by relevance, index of the search in the filter values. Every SELECT then
+            expects it once more ahead of the filter values, see ranked
+    """
+    def __init__(self, query, query_counted, count, estimate, seek, seek_null, stream,
+                 query_json, query_counted_json, seek_json, seek_null_json, stream_json, order, tables, rank=None):
+        self.query = query
+        self.query_counted = query_counted
+        self.count = count
+        self.estimate = estimate
+        self.seek = seek
+        self.seek_null = seek_null
+        self.stream = stream
+        self.query_json = query_json
+        self.query_counted_json = query_counted_json
+        self.seek_json = seek_json
+        self.seek_null_json = seek_null_json
+        self.stream_json = stream_json
+        self.order = order
+        self.tables = tables
+        self.rank = rank
+
+
+    def ranked(self, params):
+        """
+        Filter values to bind to the SELECTs of the plan, see rank.
+        """
+        return params if self.rank is None else [params[self.rank], *params]
+
 
 #####################################
 ########  Command   Helpers  ########
 #####################################
-def _build_filters(filters, table):
+def _build_pool(connection_info, config_params):
+    """
+    Build an (unopened) connection pool, tuned from the DB's config params.
+
+    :param dict connection_info: libpq connection parameters
+    :param dict config_params: the DB's PARAMS, see README
+
+    :returns: connection pool
+    :rtype: psycopg_pool.AsyncConnectionPool
+    """
+    # Format our config params for the string that ConnectionPools expect
+    strconfig = "".join([f"{key}={value} " for key, value in connection_info.items() if value])
+    # Statements executed this many times on a connection get prepared server-side.
+    # Compiled read plans skip the threshold and are always prepared, see query_plan.
+    _connection_kwargs = PSQL.GENERAL_CONNECTION_KWARGS | {
+        "prepare_threshold": config_params.get("prepare_threshold", PSQL.DEFAULT_PREPARE_THRESHOLD)
+    }
+    _prepared_max = config_params.get("prepared_max", PSQL.DEFAULT_PREPARED_MAX)
+    async def _configure(conn):
+        conn.prepared_max = _prepared_max
+    return AsyncConnectionPool(
+        strconfig,
+        connection_class=_PSQLConnection,
+        kwargs=_connection_kwargs,
+        configure=_configure,
+        min_size=config_params.get("min_pool_size", PSQL.DEFAULT_MIN_POOL_SIZE),
+        max_size=config_params.get("max_pool_size", PSQL.DEFAULT_MAX_POOL_SIZE),
+        open=False,  # per psycopg documentation
+        timeout=config_params.get("queue_timeout", PSQL.DEFAULT_WAIT_TIMEOUT),
+        max_waiting=config_params.get("max_queue_size", PSQL.DEFAULT_MAX_QUEUE_SIZE),
+        max_lifetime=config_params.get("keep_alive_for", PSQL.DEFAULT_MAX_LIFETIME),
+        max_idle=config_params.get("keep_idle_for", PSQL.DEFAULT_IDLE_TIMEOUT)
+    )
+
+
+def _pool_load(pool):
+    """
+    Connections of a pool in use or waited for, see stage_read.
+    """
+    stats = pool.get_stats()
+    return stats["pool_size"] - stats["pool_available"] + stats.get("requests_waiting", 0)
+
+
+def _index_name(table, field):
+    """
+    Name of the index Railgun manages on a column, see _managed_name.
+    """
+    return _managed_name("_ss_idx_", table, field)
+
+
+def _legacy_index_name(table, field):
+    """
+    Name column indexes used to be built under, before _managed_name. Only safe to touch when
+    Postgres didn't have to cut it short, otherwise it may be another column's index.
+
+    :returns: the old name, None if it may not be this column's
+    :rtype: str|None
+    """
+    name = "_ss_idx_{table}_{field}".format(table=table, field=field)
+    return name if len(name.encode()) <= PSQL.MAX_IDENTIFIER_LENGTH else None
+
+
+def _relation_index_name(rtable, table):
+    """
+    Name of the index of a relation table looked up from one of its sides, see index_relation_table
+    and _managed_name.
+    """
+    return _managed_name("_ss_rel_", table, rtable)
+
+
+def _managed_name(prefix, *parts):
+    """
+    Name of an object Railgun manages on behalf of some tables/columns. Postgres cuts names past
+    63 bytes, which would make long ones collide: the readable part is trimmed as needed, and a
+    hash of the full parts keeps every name distinct.
+
+    :param str prefix: kind of object
+    :param str parts: what the object belongs to
+
+    :returns: name, never longer than Postgres allows
+    :rtype: str
+    """
+    digest = sha1("\0".join(parts).encode()).hexdigest()[:12]
+    room = PSQL.MAX_IDENTIFIER_LENGTH - len(prefix) - len(digest) - 1
+    readable = "_".join(parts).encode()[:room].decode(errors="ignore")
+    return "{prefix}{readable}_{digest}".format(prefix=prefix, readable=readable, digest=digest)
+
+
+def _build_filters(filters, table, *conditions):
     """
     Build the WHERE statement of a query.
     See Railgun docs for filter format.
 
     :param dict filters: Railgun filters
     :param str table: current table
+    :param psycopg.sql.SQL conditions: any extra conditions that must hold alongside the filters
 
     :returns: WHERE statement
     :rtype: psycopg.sql.SQL
     """
-    return sql.SQL("WHERE ") + _rec_filter_con(sql.SQL(""), filters, table) if filters else sql.SQL("")
+    if filters:
+        conditions = (sql.SQL("(") + _rec_filter_con(sql.SQL(""), filters, table) + sql.SQL(")"), *conditions)
+    return sql.SQL("WHERE ") + sql.SQL(" AND ").join(conditions) if conditions else sql.SQL("")
 
 
-def _build_select_chunk(return_fields):
+def _build_seek(table, order, null=False):
+    """
+    Build the keyset condition selecting every record after the last one of the previous page,
+    following the same ORDER BY as plan_read (order column then uid, NULLs last).
+
+    :param str table: current table
+    :param str order: field the read is sorted by
+    :param bool null: whether the last order value was NULL
+
+    :returns: keyset condition, expecting the last order value (unless NULL or ordering on uid) then uid
+    :rtype: psycopg.sql.SQL
+    """
+    if order == "uid":
+        return sql.SQL("{uid} > %s").format(uid=sql.Identifier(table, "uid"))
+    if null:
+        return sql.SQL("{order} IS NULL AND {uid} > %s").format(
+            order=sql.Identifier(table, order),
+            uid=sql.Identifier(table, "uid")
+        )
+    return sql.SQL("(({order}, {uid}) > (%s, %s) OR {order} IS NULL)").format(
+        order=sql.Identifier(table, order),
+        uid=sql.Identifier(table, "uid")
+    )
+
+
+def _build_count(table, filters):
+    """
+    Build the COUNT statement matching a set of filters, regardless of pagination.
+
+    :param str table: current table
+    :param dict filters: Railgun filters
+
+    :returns: COUNT statement
+    :rtype: psycopg.sql.SQL
+    """
+    # Prep all JOINs
+    # TODO, since filters on joined tables would have an effect, but that's not in place right now.
+    baseRTJoin = sql.SQL("")
+    # baseRTJoin = _build_joins(joins, table)
+
+    # Groups are needed in case grouping causes duplication, which increases count...
+    baseGroup = sql.SQL("")
+    # if joins:
+    #     baseGroup += sql.SQL("GROUP BY {table}.{uid}").format(
+    #         table=sql.Identifier(table),
+    #         uid=sql.Identifier("uid")
+    #     )
+
+    return sql.SQL("""
+        SELECT count(*) as total_count
+        FROM {table}
+        {joins}
+        {filters}
+        {group}
+    """).format(
+        table=sql.Identifier(table),
+        joins=baseRTJoin,
+        filters=_build_filters(filters, table),
+        group=baseGroup
+    )
+
+
+def _build_page(table, filters, order, limit=sql.SQL(""), counted=False, rank=sql.SQL("")):
+    """
+    Build the subquery selecting the base table records of a single page.
+    It's aliased back to the table's name, so everything built on top of it can keep referring
+    to the table directly.
+
+    :param str table: current table
+    :param psycopg.sql.SQL filters: WHERE statement of the read
+    :param psycopg.sql.SQL order: ORDER BY columns of the read
+    :param psycopg.sql.SQL limit: LIMIT/OFFSET of the page, default everything
+    :param bool counted: add the count of every record matching the filters as _ss_total_count
+    :param psycopg.sql.SQL rank: relevance column of the page, if sorted by relevance
+
+    :returns: page FROM item
+    :rtype: psycopg.sql.SQL
+    """
+    return sql.SQL("""(
+            SELECT {table}.*{counted}{rank}
+            FROM {table}
+            {filters}
+            ORDER BY {order}
+            {limit}
+        ) AS {table}""").format(
+        table=sql.Identifier(table),
+        filters=filters,
+        order=order,
+        limit=limit,
+        counted=sql.SQL(", count(*) OVER () AS _ss_total_count") if counted else sql.SQL(""),
+        rank=rank
+    )
+
+
+def _build_select_chunk(return_fields, page, order, *extra):
     """
     Sets up the SQL "SELECT" syntax defining what values should be fetched from the table or joined
     foreign tables. This includes any JOINs required in order to SELECT the data.
 
     :param ReturnFieldSet return_fields: return fields for this query
+    :param psycopg.sql.SQL page: base table records to select from, see _build_page
+    :param psycopg.sql.SQL order: ORDER BY columns of the read, joins don't keep the page's order
+    :param psycopg.sql.SQL extra: any extra columns to select from the page
 
-    :returns: SELECT segment of SQL query
+    :returns: SELECT query
     :rtype: psycopg.sql.SQL
     """
-    base_select_chunk = sql.SQL("{return_fields} FROM {table} {entity_joins} {multientity_joins}")
+    base_select_chunk = sql.SQL("""
+        SELECT {return_fields}
+        FROM {page}
+        {entity_joins}
+        {multientity_joins}
+        ORDER BY {order}
+    """)
     rts, ejoins, mjoins = _build_return_fields(return_fields)
 
     return base_select_chunk.format(
-        return_fields=sql.SQL(",").join(rts),
-        table=sql.Identifier(return_fields.table),
+        return_fields=sql.SQL(",").join([*rts, *extra]),
+        page=page,
         entity_joins=_build_entity_joins(ejoins),
-        multientity_joins=_build_multientity_joins(mjoins)
+        multientity_joins=_build_multientity_joins(mjoins),
+        order=order
     )
 
 
+def _build_json_rows(select, counted=None):
+    """
+    Wrap a SELECT so every record comes back as the JSON text of its fields, built by PSQL,
+    rather than as columns. Railgun can send them as-is, without parsing and re-encoding.
+    Records keep the SELECT's order.
+
+    :param psycopg.sql.SQL select: SELECT to wrap, see _build_select_chunk
+    :param ReturnFieldSet counted: return fields of a SELECT that also has _ss_total_count.
+                                   Only they go in the JSON, in the same order as the others
+
+    :returns: wrapped SELECT, with the JSON text of each record as _ss_json
+    :rtype: psycopg.sql.SQL
+    """
+    if counted is not None:
+        return sql.SQL("""
+            SELECT (
+                SELECT row_to_json(_ss_record) FROM (SELECT {fields}) AS _ss_record
+            )::text AS _ss_json, _ss_page._ss_total_count
+            FROM ({select}) AS _ss_page
+        """).format(
+            fields=sql.SQL(", ").join([sql.Identifier("_ss_page", field.name) for field in counted]),
+            select=select
+        )
+    return sql.SQL("""
+        SELECT row_to_json(_ss_page)::text AS _ss_json
+        FROM ({select}) AS _ss_page
+    """).format(select=select)
+
+
 def _build_return_fields(return_fields):
     """
     Builds the top-level return fields for a query. Split into subfunction for readability.
@@ -476,7 +1645,6 @@ def _build_return_fields(return_fields):
     rts = []
     ejoins = {}
     mjoins = {}
-    print(return_fields)
     for field in return_fields:
         if type(field)==PresetReturnField:
             rts.append(
@@ -506,9 +1674,12 @@ def _build_return_fields(return_fields):
             # TODO json_agg should be done here, and formatted to accept multi-types
             multitypesubsql = []
             for ftype in field._return_fields:
-                multitypesubsql.append(sql.SQL("{table}.{field}::jsonb").format(
-                        table=sql.Identifier(field.join[ftype]["relation"]),
-                        field=sql.Identifier(field.name+"_"+field._return_fields[ftype].join["relation"])
+                # Each multi-entity join is aliased after the column it aggregates to
+                multitypesubsql.append(sql.SQL("{field}::jsonb").format(
+                        field=sql.Identifier(
+                            field.name+"_"+field._return_fields[ftype].join["relation"],
+                            field.name+"_"+field._return_fields[ftype].join["relation"]
+                        )
                     )
                 )
             rts.append(
@@ -575,6 +1746,9 @@ def _build_multientity_joins(joins):
         "field": MultiEntityReturnField
     }
 
+    Every join is a LATERAL subquery run per record of the page, aggregating only that record's
+    links through the relation table's (fk_table, table_col) rather than the whole relation table.
+
     :param dict joins: multi-entity join dict
 
     :returns: multi-entity SQL join section
@@ -584,16 +1758,18 @@ def _build_multientity_joins(joins):
     for field, returnfield in joins.items():
         ejoins = {}
         baseRTJoin += sql.SQL("""
-            LEFT JOIN (
-                SELECT {relation}.{fk_table}, json_agg({embedded_object}) AS {field}
+            LEFT JOIN LATERAL (
+                SELECT json_agg({embedded_object}) AS {field}
                 FROM {relation}
-                LEFT JOIN {ftable} ON {relation}.{fk_ftable} = {ftable}.uid
+                JOIN {ftable} ON {relation}.{fk_ftable} = {ftable}.uid
                 {ejoins}
-                GROUP BY {relation}.{fk_table}
-            ) {relation} ON {relation}.{fk_table} = {table}.uid
+                WHERE {relation}.{fk_table} = {table}.uid AND {relation}.{table_col} = {field_code}
+            ) {field} ON true
         """).format(
             relation=sql.Identifier(returnfield.join["relation"]),
             fk_table=sql.Identifier("fk_"+returnfield.table),
+            table_col=sql.Identifier(returnfield.table+"_col"),
+            field_code=sql.Literal(returnfield.name),
             ftable=sql.Identifier(returnfield.join["table"]),
             field=sql.Identifier(field),
             fk_ftable=sql.Identifier("fk_"+returnfield.join["table"]),
@@ -604,6 +1780,30 @@ def _build_multientity_joins(joins):
     return baseRTJoin
 
 
+def _read_tables(return_fields, tables):
+    """
+    Collect every table a set of return fields reads from, relation tables included.
+
+    :param ReturnFieldSet return_fields: return fields for this query
+    :param set tables: tables collected so far, added to in place
+
+    :returns: the collected tables
+    :rtype: set
+    """
+    for field in return_fields:
+        if type(field)==ReturnField:
+            tables.add(field.table)
+        elif type(field)==EntityReturnField:
+            for ftable in field.join["constraints"]:
+                tables.update((ftable["relation"], ftable["table"]))
+            _read_tables(field, tables)
+        elif type(field)==MultiEntityReturnField:
+            for subentfield in field:
+                tables.update((subentfield.join["relation"], subentfield.join["table"]))
+                _read_tables(subentfield, tables)
+    return tables
+
+
 def _rec_filter_con(straight, filter, table):
     """
     Recursive function to decompose the Railgun filter syntax into PSQL WHERE statements.
@@ -619,17 +1819,192 @@ def _rec_filter_con(straight, filter, table):
     simpletons = []
     for subfilter in filter["filters"]:
         if isinstance(subfilter, dict):
-            simpletons.append(_rec_filter_con(straight, subfilter, table))
+            # Nested filter sets need their own grouping, AND binds tighter than OR
+            simpletons.append(sql.SQL("(") + _rec_filter_con(straight, subfilter, table) + sql.SQL(")"))
+        elif len(subfilter) > 3 and subfilter[3].get("links"):
+            # Linked field, resolved by Railgun into the relations to go through
+            simpletons.append(_build_exists(table, subfilter))
         else:
             simpletons.append(
-                ### We assume receiving an element of format [<field>, <filter_operation>, <value>]
-                # HACK subfilter[4] never exists. Filters currently only work on the top level table, not joined tables
-                PSQL.FILTER_OPTIONS[subfilter[1]](table if len(subfilter)==3 else subfilter[4], subfilter[0], subfilter[2])
+                ### We assume receiving an element of format [<field>, <filter_operation>, <value>(, <resolved>)]
+                PSQL.FILTER_OPTIONS[subfilter[1]](table, subfilter[0], subfilter[2], subfilter[3] if len(subfilter) > 3 else None)
             )
-    straight += sql.SQL(" "+filter["filter_operator"]+" ").join(simpletons)
+    straight += PSQL.FILTER_OPERATORS[filter["filter_operator"].upper()].join(simpletons)
     return straight
 
 
+def _build_exists(table, subfilter):
+    """
+    Build the semi-join of a filter on a linked field. Matches if any record linked through
+    the field's path matches the filter.
+    Every table in the path is aliased by its depth, so paths going back through the same table
+    (or the base table) can't shadow each other.
+
+    Expects a filter resolved by Railgun, [<field.path>, <filter_operation>, <value>, <resolved>]:
+    {
+        "field": <field on the last linked entity>,
+        "links": [
+            {
+                "relation": <relation_table>,
+                "table": <local_table>,
+                "col": <local_field>,
+                "ftable": <foreign_table>
+            }, etc...
+        ]
+    }
+
+    :param str table: current table
+    :param list subfilter: resolved filter
+
+    :returns: EXISTS condition
+    :rtype: psycopg.sql.SQL
+    """
+    links = subfilter[3]["links"]
+    local = table
+    joins = []
+    for depth, link in enumerate(links):
+        relation = "_ss_r%s" % depth
+        ftable = "_ss_f%s" % depth
+        if depth:
+            # Link this relation to the previous level
+            joins.append(sql.SQL("JOIN {rtable} {relation} ON {relation}.{fk_table} = {local}.uid AND {relation}.{table_col} = {col}").format(
+                rtable=sql.Identifier(link["relation"]),
+                relation=sql.Identifier(relation),
+                fk_table=sql.Identifier("fk_"+link["table"]),
+                local=sql.Identifier(local),
+                table_col=sql.Identifier(link["table"]+"_col"),
+                col=sql.Literal(link["col"])
+            ))
+        joins.append(sql.SQL("JOIN {ftable_name} {ftable} ON {relation}.{fk_ftable} = {ftable}.uid").format(
+            ftable_name=sql.Identifier(link["ftable"]),
+            ftable=sql.Identifier(ftable),
+            relation=sql.Identifier(relation),
+            fk_ftable=sql.Identifier("fk_"+link["ftable"])
+        ))
+        local = ftable
+
+    return sql.SQL("""EXISTS (
+            SELECT 1 FROM {rtable} {relation}
+            {joins}
+            WHERE {relation}.{fk_table} = {table}.uid AND {relation}.{table_col} = {col} AND {condition}
+        )""").format(
+        rtable=sql.Identifier(links[0]["relation"]),
+        relation=sql.Identifier("_ss_r0"),
+        joins=sql.SQL("\n").join(joins),
+        fk_table=sql.Identifier("fk_"+links[0]["table"]),
+        table=sql.Identifier(table),
+        table_col=sql.Identifier(links[0]["table"]+"_col"),
+        col=sql.Literal(links[0]["col"]),
+        condition=PSQL.FILTER_OPTIONS[subfilter[1]](local, subfilter[3]["field"], subfilter[2], subfilter[3])
+    )
+
+
+def _build_tsquery(resolved):
+    """
+    Build the full-text query of a matches filter, expecting the search as typed by the user
+    (web search syntax: "quoted phrases", or, -excluded).
+    The language is part of the field's definition, see Railgun._resolve_filters, and the search
+    has to be parsed the same way the field was.
+
+    :param dict resolved: what Railgun resolved about the filtered field, if anything
+
+    :returns: tsquery expression
+    :rtype: psycopg.sql.SQL
+    """
+    if resolved and resolved.get("language"):
+        return sql.SQL("websearch_to_tsquery({language}::regconfig, %s)").format(language=sql.Literal(resolved["language"]))
+    return sql.SQL("websearch_to_tsquery(%s)")
+
+
+def _find_match(filter, field, params):
+    """
+    Find the first matches filter on a field, walking the Railgun filter syntax in the same order
+    as _bind_filters.
+
+    :param dict filter: this section's filter config
+    :param str field: field the matches filter is on
+    :param list params: values bound so far, appended to in place
+
+    :returns: index of the search in the bound values and what was resolved about the field, None if not found
+    :rtype: tuple|None
+    """
+    for subfilter in (filter or {}).get("filters", []):
+        if isinstance(subfilter, dict):
+            found = _find_match(subfilter, field, params)
+            if found is not None:
+                return found
+        elif subfilter[0] == field and subfilter[1] == "matches":
+            return len(params), (subfilter[3] if len(subfilter) > 3 else None)
+        else:
+            params.extend(PSQL.FILTER_BINDINGS.get(subfilter[1], _BIND_AS_IS)(subfilter[2]))
+    return None
+
+
+def _find_seq_scans(node, seq_scans):
+    """
+    Walk a JSON EXPLAIN output, collecting every sequential scan, i.e. every table read end to end
+    because no index could be used for it.
+
+    :param dict node: plan node
+    :param list seq_scans: sequential scans found so far, appended to in place
+
+    :returns: table, alias, filter and estimated rows of every sequential scan
+    :rtype: list[dict]
+    """
+    if node["Node Type"] == "Seq Scan":
+        seq_scans.append({
+            "table": node["Relation Name"],
+            "alias": node.get("Alias"),
+            "filter": node.get("Filter"),
+            "rows": node["Plan Rows"]
+        })
+    for subnode in node.get("Plans", []):
+        _find_seq_scans(subnode, seq_scans)
+    return seq_scans
+
+
+def _filter_tables(filter, tables):
+    """
+    Collect every table a set of Railgun filters reads from, see _read_tables.
+
+    :param dict filter: Railgun filters
+    :param set tables: tables collected so far, added to in place
+
+    :returns: the collected tables
+    :rtype: set
+    """
+    for subfilter in (filter or {}).get("filters", []):
+        if isinstance(subfilter, dict):
+            _filter_tables(subfilter, tables)
+        elif len(subfilter) > 3 and subfilter[3].get("links"):
+            for link in subfilter[3]["links"]:
+                tables.update((link["relation"], link["ftable"]))
+    return tables
+
+
+def _bind_filters(filter, params):
+    """
+    Recursive sibling of _rec_filter_con. Walks the Railgun filter syntax in the same order
+    placeholders are emitted, collecting the values to bind, without building any SQL.
+
+    :param dict filter: this section's filter config
+    :param list params: values to bind, appended to in place
+
+    :returns: this section and below's shape, everything but the values
+    :rtype: tuple
+    """
+    shape = [filter["filter_operator"].upper()]
+    for subfilter in filter["filters"]:
+        if isinstance(subfilter, dict):
+            shape.append(_bind_filters(subfilter, params))
+        else:
+            bound = PSQL.FILTER_BINDINGS.get(subfilter[1], _BIND_AS_IS)(subfilter[2])
+            params.extend(bound)
+            # The number of bound values is enough to tell NULL checks apart
+            shape.append((subfilter[0], subfilter[1], len(bound)))
+    return tuple(shape)
+
+
 def _embed_json_build(return_fields, joins):
     """
     Build the PSQL json_build_object chunk that's used to forward pre-formatted
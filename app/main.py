@@ -1,5 +1,5 @@
 from fastapi import Request, Depends
-from fastapi.responses import FileResponse, ORJSONResponse
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse, Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm, APIKeyCookie
 
 import orjson
@@ -14,6 +14,7 @@ import tempfile
 from config import CONFIG
 from src.railgun import Railgun
 from src.modules import railsecure
+from src.modules import railarrow
 from src.modules.railstatic import AuthStaticFiles
 
 
@@ -24,13 +25,24 @@ CONFIG.FILE_TEMP_DIR.mkdir(parents=True, exist_ok=True)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login", auto_error=False)
 cookieauth_scheme = APIKeyCookie(name="access_token", auto_error=False)
 
-async def authentication(access_token=Depends(cookieauth_scheme), token=Depends(oauth2_scheme)):
+async def authentication(request: Request, access_token=Depends(cookieauth_scheme), token=Depends(oauth2_scheme)):
     """
     Both Authorization Header and cookie authentication are allowed, matching what is
     returned by a call to /login.
     Cookie is prefered when authenticating via web, Header is prefered when authenticating via API.
     """
-    return await railsecure.authenticate_token(railgun_app, access_token or token)
+    login, permissions = await railsecure.authenticate_caller(railgun_app, access_token or token)
+    # Kept for caller, rather than decoding the token all over again
+    request.state.login = login
+    return permissions
+
+
+async def caller(request: Request, _=Depends(authentication)):
+    """
+    Login of the authenticated user, so their reads can follow their writes to the primary DB
+    when reading from replicas. authentication only runs once per request, however many depend on it.
+    """
+    return request.state.login
 
 
 @railgun_app.get("/heartbeat")
@@ -57,10 +69,10 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):  # This is di
 
 
 @railgun_app.post("/create", dependencies=[Depends(authentication)])
-async def create(request: Request):  # Typing... The root of all evil.
+async def create(request: Request, login=Depends(caller)):  # Typing... The root of all evil.
     try:
         request = orjson.loads(await request.body())
-        response = await railgun_app.create(request)
+        response = await railgun_app.create(request, caller=login)
     except JSONDecodeError:
         return "Bad request"
     except:
@@ -70,10 +82,67 @@ async def create(request: Request):  # Typing... The root of all evil.
 
 
 @railgun_app.post("/read")
-async def read(request: Request, auth=Depends(authentication)):  # Typing... The root of all evil.
+async def read(request: Request, auth=Depends(authentication), login=Depends(caller)):  # Typing... The root of all evil.
     try:
+        arrow = railarrow.wants_arrow(request.headers.get("accept"))
         request = await railgun_app.validate_request(request)
-        response = await railgun_app.read(request, auth)
+        if arrow:
+            content, headers = await railgun_app.read_arrow(request, auth, login)
+            response = Response(content, media_type=railarrow.ARROW_STREAM, headers=headers)
+        else:
+            # The response comes out of Railgun as finished JSON, see Railgun._read
+            response = Response(await railgun_app.read(request, auth, login, raw=True), media_type="application/json")
+    except:
+        raise
+        response = "Error"  # TODO
+    return response
+
+
+@railgun_app.post("/read/multi")
+async def read_multi(request: Request, auth=Depends(authentication), login=Depends(caller)):  # Typing... The root of all evil.
+    try:
+        request = orjson.loads(await request.body())
+        response = await railgun_app.read_multi(request, auth, login)
+    except JSONDecodeError:
+        return "Bad request"
+    except:
+        raise
+        response = "Error"  # TODO
+    return response
+
+
+@railgun_app.post("/read/stream")
+async def read_stream(request: Request, auth=Depends(authentication), login=Depends(caller)):  # Typing... The root of all evil.
+    try:
+        arrow = railarrow.wants_arrow(request.headers.get("accept"))
+        request = await railgun_app.validate_request(request)
+        response = StreamingResponse(
+            # Planned and checked before anything is sent, see Railgun.read_stream
+            await railgun_app.read_stream(request, auth, login, arrow=arrow),
+            media_type=railarrow.ARROW_STREAM if arrow else "application/x-ndjson"
+        )
+    except:
+        raise
+        response = "Error"  # TODO
+    return response
+
+
+@railgun_app.post("/aggregate")
+async def aggregate(request: Request, auth=Depends(authentication), login=Depends(caller)):  # Typing... The root of all evil.
+    try:
+        request = await railgun_app.validate_request(request)
+        response = await railgun_app.aggregate(request, auth, login)
+    except:
+        raise
+        response = "Error"  # TODO
+    return response
+
+
+@railgun_app.post("/facets")
+async def facets(request: Request, auth=Depends(authentication), login=Depends(caller)):  # Typing... The root of all evil.
+    try:
+        request = await railgun_app.validate_request(request)
+        response = await railgun_app.facets(request, auth, login)
     except:
         raise
         response = "Error"  # TODO
@@ -81,10 +150,23 @@ async def read(request: Request, auth=Depends(authentication)):  # Typing... The
 
 
 @railgun_app.post("/update", dependencies=[Depends(authentication)])
-async def update(request: Request):  # Typing... The root of all evil.
+async def update(request: Request, login=Depends(caller)):  # Typing... The root of all evil.
+    try:
+        request = orjson.loads(await request.body())
+        response = await railgun_app.update(request, caller=login)
+    except JSONDecodeError:
+        return "Bad request"
+    except:
+        raise
+        response = "Error"  # TODO
+    return response
+
+
+@railgun_app.post("/upsert", dependencies=[Depends(authentication)])
+async def upsert(request: Request, login=Depends(caller)):  # Typing... The root of all evil.
     try:
         request = orjson.loads(await request.body())
-        response = await railgun_app.update(request)
+        response = await railgun_app.upsert(request, caller=login)
     except JSONDecodeError:
         return "Bad request"
     except:
@@ -94,10 +176,10 @@ async def update(request: Request):  # Typing... The root of all evil.
 
 
 @railgun_app.post("/delete", dependencies=[Depends(authentication)])
-async def delete(request: Request):  # Typing... The root of all evil.
+async def delete(request: Request, login=Depends(caller)):  # Typing... The root of all evil.
     try:
         request = orjson.loads(await request.body())
-        response = await railgun_app.delete(request)
+        response = await railgun_app.delete(request, caller=login)
     except JSONDecodeError:
         return "Bad request"
     except:
@@ -106,11 +188,11 @@ async def delete(request: Request):  # Typing... The root of all evil.
     return response
 
 
-@railgun_app.post("/batch", dependencies=[Depends(authentication)])
-async def batch(request: Request):  # Typing... The root of all evil.
+@railgun_app.post("/batch")
+async def batch(request: Request, auth=Depends(authentication), login=Depends(caller)):  # Typing... The root of all evil.
     try:
         request = orjson.loads(await request.body())
-        response = await railgun_app.batch(request)
+        response = await railgun_app.batch(request, auth, login)
     except JSONDecodeError:
         return "Bad request"
     except:
@@ -143,6 +225,17 @@ async def stellar(request: Request):  # Typing... The root of all evil.
     return response
 
 
+@railgun_app.post("/stellar/indexes", dependencies=[Depends(authentication)])
+async def stellar_indexes(request: Request):  # Typing... The root of all evil.
+    try:
+        request = await railgun_app.validate_request(request)
+        response = await railgun_app.index_status(request)
+    except:
+        raise
+        response = "Error"  # TODO
+    return response
+
+
 @railgun_app.post("/stellar/{internal_entity}/{operation}")
 async def stellar(request: Request, internal_entity, operation, auth=Depends(authentication)):  # Typing... The root of all evil.
     try:
@@ -157,7 +250,7 @@ async def stellar(request: Request, internal_entity, operation, auth=Depends(aut
 
 
 @railgun_app.post("/upload", dependencies=[Depends(authentication)])
-async def upload(request: Request):  # Typing... The root of all evil.
+async def upload(request: Request, login=Depends(caller)):  # Typing... The root of all evil.
     # TODO forward process to railgun, the logic shouldn't be here
     boundary = ("--"+request.headers["content-type"].split("boundary=")[1]).encode('ascii')
 
@@ -220,7 +313,7 @@ async def upload(request: Request):  # Typing... The root of all evil.
     print(filename)
     print(temp_file_path)
     try:
-        return await railgun_app.upload_file(temp_file_path, filename, metadata)
+        return await railgun_app.upload_file(temp_file_path, filename, metadata, caller=login)
     except:
         # TODO
         raise
@@ -0,0 +1,147 @@
+"""
+Redis-backed /read result cache, riding on the comet Redis every Railgun instance already shares.
+Opt-in per entity through the "read_cache" db_secrets param ({<entity>: <ttl in seconds>}).
+Cached counts (see Railgun._count) are keyed on the same table versions.
+
+Every key embeds the current version of each table the read touches. Writes bump the versions
+of the tables they touch once committed, so every instance stops hitting the stale entries at the
+same time, and the stale entries simply expire.
+Redis hiccups never fail a read or a write, the cache just gets skipped.
+
+Also keeps track of callers pinned to the primary after writing, for DBs with read replicas
+(see the "read_your_writes" db_secrets param), so it holds whichever instance they hit next.
+"""
+from hashlib import sha1
+
+import orjson
+from redis.exceptions import RedisError
+
+
+_VERSION_KEY = "railgun:version:{schema}:{table}"
+_READ_KEY = "railgun:read:{schema}:{digest}"
+_PIN_KEY = "railgun:pin:{schema}:{caller}"
+
+
+async def fetch_read(comet, schema, plan, params, request, permissions, raw=False):
+    """
+    Look up the result of a read.
+    Table versions are fetched before the read runs, so a write committing while the read is in
+    flight can only ever leave a result behind under a key that's already stale.
+
+    :param redis.asyncio.Redis comet: comet Redis connection
+    :param str schema: schema being read
+    :param ReadPlan plan: compiled read
+    :param list params: bound filter values
+    :param dict request: read request, for the pagination options
+    :param set permissions: user permissions
+    :param bool raw: return the cached result as its JSON bytes, see Railgun._read
+
+    :returns: key to store the result under (None if Redis is unavailable), and the cached result if any
+    :rtype: str|None, list|bytes|None
+    """
+    versions = await table_versions(comet, schema, plan.tables)
+    if versions is None:
+        return None, None
+    try:
+        digest = sha1(orjson.dumps([
+            plan.stream,
+            params,
+            sorted(plan.tables),
+            versions,
+            sorted(permissions),
+            {option: request["read"].get(option) for option in ("page", "pagination", "cursor", "include_count", "count_strategy")}
+        ])).hexdigest()
+        key = _READ_KEY.format(schema=schema, digest=digest)
+        cached = await comet.get(key)
+    except RedisError as e:
+        print(f"Read cache unavailable: {e}")  # TODO log
+        return None, None
+    if cached is None or raw:
+        return key, cached
+    return key, orjson.loads(cached)
+
+
+async def store_read(comet, key, result, ttl):
+    """
+    Cache the result of a read, see fetch_read.
+
+    :param redis.asyncio.Redis comet: comet Redis connection
+    :param str key: key returned by fetch_read
+    :param list|bytes result: read result, or its JSON bytes
+    :param int ttl: seconds to keep the result for
+    """
+    try:
+        await comet.set(key, result if isinstance(result, bytes) else orjson.dumps(result), ex=ttl)
+    except RedisError as e:
+        print(f"Read cache unavailable: {e}")  # TODO log
+
+
+async def table_versions(comet, schema, tables):
+    """
+    Current version of tables, see bump_tables. Anything keyed on them goes stale on every
+    instance at once as soon as one of them is written to.
+
+    :param redis.asyncio.Redis comet: comet Redis connection
+    :param str schema: schema being read
+    :param set tables: tables read
+
+    :returns: version of each table, sorted by table. None if Redis is unavailable
+    :rtype: tuple|None
+    """
+    try:
+        versions = await comet.mget([_VERSION_KEY.format(schema=schema, table=table) for table in sorted(tables)])
+    except RedisError as e:
+        print(f"Read cache unavailable: {e}")  # TODO log
+        return None
+    return tuple(int(version or 0) for version in versions)
+
+
+async def bump_tables(comet, schema, tables):
+    """
+    Bump the version of tables that were just written to, invalidating every cached read
+    touching them on every instance. Only call once the write is committed.
+
+    :param redis.asyncio.Redis comet: comet Redis connection
+    :param str schema: schema written to
+    :param set tables: tables written to
+    """
+    try:
+        async with comet.pipeline(transaction=False) as pipe:
+            for table in tables:
+                pipe.incr(_VERSION_KEY.format(schema=schema, table=table))
+            await pipe.execute()
+    except RedisError as e:
+        print(f"Read cache unavailable, cached reads of {tables} may be stale: {e}")  # TODO log
+
+
+async def pin_caller(comet, schema, caller, seconds):
+    """
+    Pin a caller's reads to the primary for a while, after they wrote to it.
+
+    :param redis.asyncio.Redis comet: comet Redis connection
+    :param str schema: schema written to
+    :param str caller: login of the caller
+    :param int|float seconds: how long to pin them for
+    """
+    try:
+        await comet.set(_PIN_KEY.format(schema=schema, caller=caller), 1, px=int(seconds*1000))
+    except RedisError as e:
+        print(f"Read pins unavailable, {caller} may not read their own writes: {e}")  # TODO log
+
+
+async def is_pinned(comet, schema, caller):
+    """
+    Whether a caller's reads are pinned to the primary, see pin_caller.
+    If Redis can't tell, they are. The primary is never behind.
+
+    :param redis.asyncio.Redis comet: comet Redis connection
+    :param str schema: schema being read
+    :param str caller: login of the caller
+
+    :rtype: bool
+    """
+    try:
+        return bool(await comet.exists(_PIN_KEY.format(schema=schema, caller=caller)))
+    except RedisError as e:
+        print(f"Read pins unavailable: {e}")  # TODO log
+        return True
@@ -37,6 +37,8 @@ def _validate_config(db):
         assert db.get("DB_TYPE") in DB_TYPES
         assert "DB_NAME" in db["PARAMS"]
         assert "DB_USER" in db["PARAMS"]
+        assert isinstance(db["PARAMS"].get("REPLICAS", []), list)
+        assert all(isinstance(replica, dict) for replica in db["PARAMS"].get("REPLICAS", []))
     except AssertionError:
         return False
     return True
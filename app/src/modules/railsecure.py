@@ -61,6 +61,21 @@ async def authenticate_token(railgun_app, incoming_token):
     :param railgun.Railgun railgun_app: the Railgun app, used to fetch users.
     :param str incoming_token: auth token provided in the request
     """
+    return (await authenticate_caller(railgun_app, incoming_token))[1]
+
+
+async def authenticate_caller(railgun_app, incoming_token):
+    """
+    Same as authenticate_token, also returning the login the token was issued to.
+
+    :param railgun.Railgun railgun_app: the Railgun app, used to fetch users.
+    :param str incoming_token: auth token provided in the request
+
+    :returns: login and permission groups of the user
+    :rtype: str, set
+
+    :raises HTTPException: 405 if the token is invalid, expired or revoked
+    """
     try:
         detokened = jwt.decode(incoming_token, CONFIG.TOKENIZER_KEY, algorithms=[CONFIG.TOKENIZER_ALGO])
         requested_login = detokened["sub"]
@@ -68,7 +83,7 @@ async def authenticate_token(railgun_app, incoming_token):
             # All tokens with an expiration before the invalidation time should be considered revoked.
             # If the user isn't cached, they've been removed and a KeyError will trigger.
             raise InvalidTokenError()
-        return railgun_app.STELLAR.USER_CACHE[requested_login].permission_groups
+        return requested_login, railgun_app.STELLAR.USER_CACHE[requested_login].permission_groups
     except (InvalidTokenError, KeyError):
         raise HTTPException(
             status_code=405,
@@ -1,5 +1,12 @@
+import asyncio
+from contextlib import nullcontext, AsyncExitStack
 from pathlib import Path
 from json import JSONDecodeError
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+import orjson
+from psycopg import AsyncCursor
+from psycopg.errors import QueryCanceled, InvalidColumnReference
 
 # Needed for one op
 import shutil
@@ -9,17 +16,20 @@ from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from src.modules.railconfig import RailConfig
+from src.modules import railcache
+from src.modules import railarrow
 from src.stellar_stellar import StellarStellar
+from db import PSQL
 from db._database import CUDError
 from config import CONFIG
 from src.structures.returnfields import ReturnFieldSet, PresetReturnField, ReturnField, EntityReturnField, MultiEntityReturnField
 from src.structures.internal_ops import InternalOperations
 
 
-_DEFAULT_QUERY_FILTER = lambda request:{
+_DEFAULT_QUERY_FILTER = lambda options:{
     "filter_operator": "AND",
     "filters": [
-        ["_ss_archived", "is", bool(request["read"].get("show_archived", False))],  # Some hubris to allow proper parsing of false values
+        ["_ss_archived", "is", bool(options.get("show_archived", False))],  # Some hubris to allow proper parsing of false values
     ]
 }
 
@@ -31,6 +41,149 @@ ALLOWED_CORS_ORIGINS = [
 ]
 ALLOWED_CORS_ORIGINS.extend(CONFIG.RG_URLS)
 
+# Fields /facets can count the values of, anything else has too many values, or links
+FACET_FIELD_TYPES = ("LIST", "BOOL", "ENTITY")
+
+# Reads a single /read/multi may ask for
+MAX_MULTI_READS = 16
+# Share of a pool the reads of a /read/multi may hold at once, each holds its own pooled connection
+MULTI_READ_POOL_SHARE = 4  # 1/4
+
+
+def _encode_cursor(order, order_value, uid):
+    """
+    Build the opaque keyset cursor pointing after a record.
+
+    :param str order: field the read is sorted by
+    :param Any order_value: the record's value for the order field
+    :param int uid: the record's uid
+
+    :returns: cursor to pass as the "cursor" read option for the next page
+    :rtype: str
+    """
+    return urlsafe_b64encode(orjson.dumps([order, order_value, uid])).decode()
+
+
+def _decode_cursor(cursor, order):
+    """
+    Unpack a keyset cursor built by _encode_cursor.
+
+    :param str cursor: cursor returned by a previous page
+    :param str order: field the read is sorted by, must match the one the cursor was built for
+
+    :returns: (order value, uid) of the last record of the previous page
+    :rtype: tuple
+
+    :raises HTTPException: 400 if the cursor is malformed or was built for a different order
+    """
+    try:
+        cursor_order, order_value, uid = orjson.loads(urlsafe_b64decode(cursor))
+        assert cursor_order == order
+    except (ValueError, TypeError, AssertionError):
+        raise HTTPException(400, "Invalid cursor for order %s" % order)
+    return order_value, uid
+
+
+def _split_read(resp, request):
+    """
+    Split a read response back into its records, count and cursor, see Railgun._read.
+    The request says which of them were appended, so nothing has to be guessed from the records.
+
+    :param list resp: read response, records then the count and cursor asked for
+    :param dict request: read request it answers
+
+    :returns: records, count (None if not asked for) and next cursor (None if not asked for or none left)
+    :rtype: list, dict|None, str|None
+    """
+    resp = list(resp)
+    next_cursor = resp.pop()["cursor"] if request["read"].get("cursor") else None
+    total_count = resp.pop() if request["read"].get("include_count") else None
+    return resp, total_count, next_cursor
+
+
+def _search_language(field_sc):
+    """
+    Language a field's searches must be parsed with, if it's a SEARCH field. See _resolve_filters.
+    """
+    if field_sc.type == "SEARCH" and field_sc.params.get("language"):
+        return {"language": field_sc.params["language"]}
+    return {}
+
+
+def _tightest(limit, requested, option):
+    """
+    Resolve a read limit from the DB's and the one requested by the read, which may only tighten it.
+
+    :param int|float limit: the DB's limit, if any
+    :param int|float requested: the read's limit, if any
+    :param str option: name of the read option, for errors
+
+    :returns: limit to apply, None for none
+    :rtype: int|float|None
+
+    :raises HTTPException: 400 if the requested limit isn't a positive number
+    """
+    if requested is None:
+        return limit
+    if isinstance(requested, bool) or not isinstance(requested, (int, float)) or requested <= 0:
+        raise HTTPException(status_code=400, detail="%s must be a positive number" % option)
+    return min(limit, requested) if limit else requested
+
+
+def _join_depth(return_fields, filters):
+    """
+    How many linked entities deep a read goes, through its return fields or filters.
+    "assets.Asset.department.Department.code" is 2 deep.
+
+    :param list return_fields: requested return fields
+    :param dict filters: requested filters
+
+    :returns: join depth
+    :rtype: int
+    """
+    depth = max((field.count(".")//2 for field in return_fields), default=0)
+    for subfilter in (filters or {}).get("filters", []):
+        if isinstance(subfilter, dict):
+            depth = max(depth, _join_depth([], subfilter))
+        else:
+            depth = max(depth, subfilter[0].count(".")//2)
+    return depth
+
+
+def _link_sets(links):
+    """
+    Entities to link to on an entity field, by type. dict keeps the order and drops repeats.
+
+    :param list[dict] links: [{"type": <entity>, "uid": <uid>}...]
+
+    :returns: {<entity>: {<uid>: None}}
+    :rtype: dict
+    """
+    sets = {}
+    for link in links:
+        sets.setdefault(link["type"], {})[int(link["uid"])] = None
+    return sets
+
+
+def _uses_copy(batch, threshold):
+    """
+    Whether a batch has a group of consecutive creates large enough to be COPY'd, see Railgun._create_many.
+    Errs on the side of yes, groups may get split further once the middleware has run.
+
+    :param list[dict] batch: CUD operations
+    :param int threshold: the DB's copy_threshold
+
+    :rtype: bool
+    """
+    run, previous = 0, None
+    for op in batch:
+        current = (op.get("entity"), op.get("data", {}).keys()) if op.get("request_type") == "create" else None
+        run = run + 1 if current is not None and current == previous else 1
+        if current is not None and run >= threshold:
+            return True
+        previous = current
+    return False
+
 
 class Railgun(FastAPI):
     """
@@ -72,17 +225,62 @@ class Railgun(FastAPI):
         return request
 
 
-    async def read(self, request, permissions):
+    async def read(self, request, permissions, caller=None, raw=False, split=False, cache=True):
         """
         Prepare for a read request
-        Essentially just pick your DB.
+        Essentially just pick your DB (and replica, see _read_primary).
+        With raw, the response is returned as its finished JSON bytes, see _read.
+        With split, the count and cursor are returned apart from the records, see _read.
+        Without cache, the read cache is neither used nor filled, see _read.
         """
         _db_pool = self.data[request["schema"]]
-        async with _db_pool.stage() as db:
-            resp = await self._read(db, request, permissions)
+        try:
+            async with _db_pool.stage_read(primary=await self._read_primary(request, caller, cache=cache)) as db:
+                resp = await self._read(db, request, permissions, raw=raw, split=split, cache=cache)
+        except QueryCanceled:
+            # statement_timeout, see _limit_read
+            raise HTTPException(status_code=503, detail="Read took too long and was cancelled, narrow it down (filters, pagination, return_fields)")
         return resp
 
-    async def _read(self, db, request, permissions):
+    async def read_multi(self, request, permissions, caller=None):
+        """
+        Run several independent reads concurrently, each on its own pooled connection.
+        At most a quarter of the pool (see MULTI_READ_POOL_SHARE) is held at once.
+        Expected format:
+        {
+            "reads": [<read request>, etc...]
+        }
+        Every read request is the same as for _read, and can target any schema.
+
+        :param dict request: multi-read request
+        :param set permissions: user permissions
+        :param str caller: login of the user, see _pinned
+
+        :returns: results of each read, in the same order as requested
+        :rtype: list[list]
+
+        :raises HTTPException: 400 if malformed, or too many reads are requested at once
+        """
+        reads = request.get("reads")
+        if not isinstance(reads, list):
+            raise HTTPException(status_code=400, detail="Expected a list of reads")
+        if len(reads) > MAX_MULTI_READS:
+            raise HTTPException(status_code=400, detail="Too many reads, at most %s at once" % MAX_MULTI_READS)
+        for read_request in reads:
+            if not isinstance(read_request, dict) or read_request.get("schema") not in self.data:
+                raise HTTPException(status_code=400, detail="Every read needs a valid schema")
+        # Leave most of the pool to other requests, the rest of the reads wait their turn
+        concurrency = asyncio.Semaphore(max(1, min(
+            self.data[read_request["schema"]].pool.max_size for read_request in reads
+        ) // MULTI_READ_POOL_SHARE)) if reads else None
+
+        async def _read_one(read_request):
+            async with concurrency:
+                return await self.read(read_request, permissions, caller)
+        return await asyncio.gather(*[_read_one(read_request) for read_request in reads])
+
+
+    async def _read(self, db, request, permissions, raw=False, split=False, cache=True):
         """
         Fetch data from a DB.
         Expected format:
@@ -94,44 +292,714 @@ class Railgun(FastAPI):
                 "page": Page number,
                 "pagination": Entries per page,
                 "order": Field to sort by
-                "filters": Filter set (see app docs TODO)
+                "filters": Filter set (see app docs TODO),
+                "cursor": True for the first page, then the previous page's cursor (keyset pagination, OPTIONAL)
+                "include_count": Append the total number of matching records (OPTIONAL)
+                "count_strategy": "exact"|"estimate"|"cached", defaults to the DB's (OPTIONAL)
+                "explain": Return the query plan and its sequential scans instead of records (OPTIONAL)
+                "relevance": SEARCH field to sort by relevance to its matches filter, instead of order (OPTIONAL)
+                "statement_timeout": Cancel the read after this many ms, only tighter than the DB's (OPTIONAL)
+                "max_cost": Reject the read past this query planner cost, only tighter than the DB's (OPTIONAL)
             }
         }
         Expecting set of permissions.
         HACK (tbf the entire permission setup currently is a hack), we assume that if no
         permission set is provided, use full permissions. This is bad (obviously).
+        With raw, PSQL builds the JSON of every record itself, and the whole response is returned
+        as JSON bytes ready to be sent, without ever building the records in Python.
+        With split (internal, not with raw), the records, count and next cursor are returned apart,
+        rather than the count and cursor being appended to the records.
+        Without cache (internal), the read cache is skipped even if the entity is listed in read_cache:
+        cached records come back from JSON, with none of the types PSQL returned them as.
+        """
+        planned = self._plan_read(db, request, permissions)
+        if planned is None:
+            if split:
+                return [], None, None
+            return b"[]" if raw else []
+        plan, params = planned
+
+        if request["read"].get("explain"):
+            # Diagnostics, report how the read would run rather than running it
+            explained = await db.explain_plan(
+                plan,
+                params,
+                pagination=request["read"].get("pagination") or 25,
+                page=request["read"].get("page") or 1
+            )
+            return orjson.dumps(explained) if raw else explained
+
+        # Opt-in per entity, see src.modules.railcache
+        read_cache_ttl = self.data[request["schema"]].read_cache.get(request["entity"]) if cache else None
+        if read_cache_ttl:
+            cache_key, cached = await railcache.fetch_read(self.STELLAR.comet, request["schema"], plan, params, request, permissions, raw=raw)
+            if cached is not None:
+                return _split_read(cached, request) if split else cached
+
+        # Keyset pagination, opt-in. True for the first page, then the cursor returned by the previous page.
+        cursor = request["read"].get("cursor")
+        keyset = _decode_cursor(cursor, plan.order) if cursor and cursor is not True else None
+        # page is ignored with cursors, the first one starts from the top
+        page = 1 if cursor else (request["read"].get("page") or 1)
+
+        await self._limit_read(
+            db,
+            request,
+            plan,
+            params,
+            pagination=request["read"].get("pagination") or 25,
+            page=page
+        )
+
+        query_total_count = None
+        count_strategy = None
+        if bool(request["read"].get("include_count", False)):
+            count_strategy = request["read"].get("count_strategy") or self.data[request["schema"]].count_strategy
+            if count_strategy not in PSQL.COUNT_STRATEGIES:
+                raise HTTPException(status_code=400, detail="Unknown count_strategy: %s" % count_strategy)
+
+        pagination = request["read"].get("pagination") or 25
+        if keyset:
+            resp = await db.seek_plan(plan, params, keyset, pagination=pagination, raw=raw)
+        elif count_strategy == "exact":
+            # Count in the same statement as the page, saves the second scan and round trip
+            resp, query_total_count = await db.query_count_plan(
+                plan,
+                params,
+                pagination=pagination,
+                page=page,
+                raw=raw
+            )
+        else:
+            resp = await db.query_plan(
+                plan,
+                params,
+                pagination=pagination,
+                page=page,
+                raw=raw
+            )
+        # A short page means there's nothing left to seek to
+        next_cursor = None
+        if cursor and len(resp) == pagination:
+            last = orjson.loads(resp[-1]) if raw else resp[-1]
+            next_cursor = _encode_cursor(plan.order, last[plan.order], last["uid"])
+
+        records = resp
+        if count_strategy:
+            if query_total_count is None:
+                query_total_count = await self._count(db, request["schema"], plan, params, count_strategy)
+            resp = resp + [query_total_count]
+        if cursor:
+            resp = resp + [{"cursor": next_cursor}]
+        if raw:
+            # Records are already JSON, only the count and cursor need encoding
+            resp = b"[" + b",".join(
+                entry.encode() if isinstance(entry, str) else orjson.dumps(entry) for entry in resp
+            ) + b"]"
+        if read_cache_ttl and cache_key:
+            await railcache.store_read(self.STELLAR.comet, cache_key, resp, read_cache_ttl)
+        if split:
+            return records, query_total_count, next_cursor
+        return resp
+
+
+    async def _count(self, db, schema, plan, params, count_strategy):
+        """
+        Count the records matching a read on its own, when it couldn't be done with the page.
+        - exact: COUNT of the filters
+        - estimate: the query planner's row estimate, no scan at all
+        - cached: exact, reused until the TTL runs out or any instance writes to a table read
+
+        :param db._database.Database db: staged DB connection
+        :param str schema: schema being read
+        :param ReadPlan plan: compiled read
+        :param list params: bound filter values
+        :param str count_strategy: one of PSQL.COUNT_STRATEGIES
+
+        :returns: {"total_count": <int>}
+        :rtype: dict
+        """
+        match count_strategy:
+            case "estimate":
+                return await db.estimate_plan(plan, params)
+            case "cached":
+                # Writes on any instance bump the versions, see _written
+                versions = await railcache.table_versions(self.STELLAR.comet, schema, plan.tables)
+                if versions is None:
+                    # No telling if a cached count is stale
+                    return await db.count_plan(plan, params)
+                count_key = (schema, plan.tables, plan.count, orjson.dumps(params), versions)
+                query_total_count = self.STELLAR.READ_COUNTS.fresh(count_key, self.data[schema].count_cache_ttl)
+                if query_total_count is None:
+                    query_total_count = await db.count_plan(plan, params)
+                    self.STELLAR.READ_COUNTS[count_key] = query_total_count
+                return query_total_count
+            case _:
+                return await db.count_plan(plan, params)
+
+
+    async def read_arrow(self, request, permissions, caller=None):
+        """
+        Same as read, as an Arrow IPC stream (see src.modules.railarrow).
+        The count and cursor don't fit in the stream, they're returned as headers instead:
+            X-Railgun-Total-Count (and X-Railgun-Count-Estimated), X-Railgun-Cursor
+
+        :param dict request: read request, see _read
+        :param set permissions: user permissions
+        :param str caller: login of the user, see _pinned
+
+        :returns: Arrow IPC stream and response headers
+        :rtype: bytes, dict
+
+        :raises HTTPException: 400 if asking for explain, which is only available as JSON
+        """
+        if request["read"].get("explain"):
+            raise HTTPException(status_code=400, detail="explain is only available as JSON")
+        arrow = railarrow.ArrowStream(self._arrow_columns(request))
+        # Arrow columns are typed, cached records are JSON (DATEs as strings...), see _read
+        records, total_count, next_cursor = await self.read(request, permissions, caller, split=True, cache=False)
+
+        headers = {}
+        if request["read"].get("cursor"):
+            headers["X-Railgun-Cursor"] = next_cursor or ""
+        if total_count is not None:
+            headers["X-Railgun-Total-Count"] = str(total_count["total_count"])
+            if total_count.get("estimated"):
+                headers["X-Railgun-Count-Estimated"] = "true"
+        return arrow.write(records) + arrow.close(), headers
+
+
+    async def read_stream(self, request, permissions, caller=None, arrow=False):
+        """
+        Stream every record matching a read request, ignoring pagination, as NDJSON chunks.
+        Records are pulled through a server-side cursor a chunk at a time, so memory stays flat
+        regardless of how many records match.
+        The read is planned, checked against the DB's limits and its first chunk fetched before
+        anything is returned, so a bad read fails with a proper status instead of a cut off 200.
+        Expected format is the same as for _read, with the extra (OPTIONAL) read option:
+            "chunk_size": number of records fetched from the DB per chunk
+
+        :param dict request: read request
+        :param set permissions: user permissions
+        :param str caller: login of the user, see _pinned
+        :param bool arrow: stream an Arrow IPC stream instead, a record batch per chunk
+
+        :returns: NDJSON chunks, one record per line
+        :rtype: AsyncGenerator[bytes]
+
+        :raises HTTPException: 400 if malformed or too expensive, 503 if the first chunk took too long
+        """
+        if arrow:
+            arrow_stream = railarrow.ArrowStream(self._arrow_columns(request))
+            chunks = self._stream_chunks(*await self._open_stream(request, permissions, caller))
+            return self._read_stream_arrow(arrow_stream, chunks)
+        # Records come out of PSQL as JSON already, see _read
+        chunks = self._stream_chunks(*await self._open_stream(request, permissions, caller, raw=True))
+        return self._read_stream_ndjson(chunks)
+
+    async def _read_stream_ndjson(self, chunks):
+        async for records in chunks:
+            yield "".join(record + "\n" for record in records).encode()
+
+    async def _read_stream_arrow(self, arrow_stream, chunks):
+        """
+        Arrow flavour of read_stream. The stream is always complete, even if empty.
+        """
+        async for records in chunks:
+            yield arrow_stream.write(records)
+        yield arrow_stream.close()
+
+    async def _open_stream(self, request, permissions, caller=None, raw=False):
+        """
+        Shared setup of every flavour of read_stream: stage a connection, plan the read, apply the
+        DB's limits and fetch the first chunk. The connection stays staged until the stream is done,
+        see _stream_chunks.
+
+        :param dict request: read request, see read_stream
+        :param set permissions: user permissions
+        :param str caller: login of the user, see _pinned
+        :param bool raw: stream records as their JSON text, see _PSQLConnection.stream_plan
+
+        :returns: exit stack of the staged connection, first chunk and the chunks left,
+                  None if the user may not read this entity at all
+        :rtype: contextlib.AsyncExitStack, list, AsyncGenerator|None
+
+        :raises HTTPException: 400 if malformed or too expensive, 503 if the first chunk took too long
+        """
+        _db_pool = self.data[request["schema"]]
+        chunk_size = request["read"].get("chunk_size") or PSQL.DEFAULT_STREAM_CHUNK_SIZE
+        if _db_pool.max_pagination and chunk_size > _db_pool.max_pagination:
+            raise HTTPException(status_code=400, detail="chunk_size is limited to %s" % _db_pool.max_pagination)
+        staged = AsyncExitStack()
+        db = await staged.enter_async_context(_db_pool.stage_read(primary=await self._pinned(request["schema"], caller)))
+        try:
+            planned = self._plan_read(db, request, permissions)
+            if planned is None:
+                await staged.aclose()
+                return staged, [], None
+            plan, params = planned
+            # The timeout applies to every chunk, not the whole stream
+            await self._limit_read(db, request, plan, params)
+            chunks = db.stream_plan(plan, params, chunk_size=chunk_size, raw=raw)
+            # The server-side cursor has to go before its connection does
+            staged.push_async_callback(chunks.aclose)
+            first = await anext(chunks, [])
+        except BaseException as e:
+            await staged.__aexit__(type(e), e, e.__traceback__)
+            if isinstance(e, QueryCanceled):
+                # statement_timeout, see _limit_read
+                raise HTTPException(status_code=503, detail="Read took too long and was cancelled, narrow it down (filters, chunk_size, return_fields)")
+            raise
+        return staged, first, chunks
+
+    async def _stream_chunks(self, staged, first, chunks):
+        """
+        Every chunk of a stream opened by _open_stream, releasing its connection once done or abandoned.
+        """
+        async with staged:
+            records = first
+            while records:
+                yield records
+                records = await anext(chunks, []) if chunks else []
+
+
+    def _arrow_columns(self, request):
+        """
+        Columns of a read's records, in order, with the STELLAR type of each, see railarrow.ArrowStream.
+        Mirrors what _plan_read adds to the requested return fields.
+
+        :param dict request: read request, see _read
+
+        :returns: {<column name>: <field type, None if not a field>}
+        :rtype: dict
+        """
+        entity_sc = self.STELLAR.STELLAR[request["schema"]].entities[request["entity"]]
+        names = [
+            "type",
+            # Linked fields all come back under their top-level field
+            *(field.split(".")[0] for field in request["read"].get("return_fields", [])),
+            "uid",
+            entity_sc.display_name_col
+        ]
+        if request["read"].get("cursor"):
+            names.append(request["read"].get("order") or "uid")
+        columns = {}
+        for name in names:
+            columns.setdefault(name, entity_sc.fields[name].type if name in entity_sc.fields else None)
+        return columns
+
+
+    async def aggregate(self, request, permissions, caller=None):
+        """
+        Aggregate the records matching a set of filters server-side, in a single GROUP BY query.
+        Filters and permissions are handled exactly as for _read.
+        Expected format:
+        {
+            "schema": Schema code,
+            "entity": Entity code,
+            "aggregate": {
+                "group_by": [<field>, <single-entity linked field dot-path>, {"field": <DATE field>, "bucket": "day"|"week"|"month"|"quarter"|"year"}] (OPTIONAL)
+                "aggregates": [{"function": "count"|"sum"|"avg"|"min"|"max", "field": <field>}] (OPTIONAL, default count)
+                "filters": Filter set, same as _read (OPTIONAL)
+                "show_archived": Same as _read (OPTIONAL)
+            }
+        }
+        Every group is returned as a record, keyed by the group_by fields and the aggregates,
+        e.g. {"status": "final", "count": 12, "sum_duration": 480}
+
+        :param dict request: aggregate request
+        :param set permissions: user permissions
+        :param str caller: login of the user, see _pinned
+
+        :returns: a record per group, sorted by group
+        :rtype: list[dict]
+
+        :raises HTTPException: 400 if malformed
+        """
+        schema_sc = self.STELLAR.STELLAR[request["schema"]].entities
+        entity_sc = schema_sc[request["entity"]]
+        _db_pool = self.data[request["schema"]]
+        options = request.get("aggregate") or {}
+
+        groups = []
+        for group in options.get("group_by", []):
+            bucket = None
+            if isinstance(group, dict):
+                group, bucket = group.get("field"), group.get("bucket")
+            if not isinstance(group, str):
+                raise HTTPException(status_code=400, detail="Malformed group_by: %s" % group)
+            links, field_sc = self._resolve_links(schema_sc, request["entity"], group.split("."))
+            if not field_sc or field_sc.type in ("ENTITY", "MULTIENTITY") or len(group.split("."))%2 != 1:
+                raise HTTPException(status_code=400, detail="Cannot group by %s" % group)
+            if any(link["type"] != "ENTITY" for link in links):
+                # Records would be counted once per link
+                raise HTTPException(status_code=400, detail="Can only group through single-entity fields: %s" % group)
+            if bucket and (field_sc.type != "DATE" or bucket not in PSQL.DATE_BUCKETS):
+                raise HTTPException(status_code=400, detail="Cannot bucket %s by %s" % (group, bucket))
+            groups.append({"name": group, "field": field_sc.code, "links": links, "bucket": bucket})
+
+        aggregates = []
+        for aggregate in options.get("aggregates") or [{"function": "count"}]:
+            if not isinstance(aggregate, dict) or aggregate.get("function") not in PSQL.AGGREGATE_FUNCTIONS:
+                raise HTTPException(status_code=400, detail="Malformed aggregate: %s" % aggregate)
+            field_sc = entity_sc.fields.get(aggregate["field"]) if aggregate.get("field") else None
+            if aggregate.get("field") and (not field_sc or field_sc.type in ("ENTITY", "MULTIENTITY")):
+                raise HTTPException(status_code=400, detail="Cannot aggregate %s" % aggregate["field"])
+            if aggregate["function"] != "count" and (not field_sc or field_sc.type not in PSQL.AGGREGATE_FUNCTION_TYPES[aggregate["function"]]):
+                raise HTTPException(status_code=400, detail="Cannot %s %s" % (aggregate["function"], aggregate.get("field")))
+            aggregates.append({
+                "name": aggregate["function"]+"_"+field_sc.code if field_sc else aggregate["function"],
+                "function": aggregate["function"],
+                "field": field_sc.code if field_sc else None,
+                "type": field_sc.type if field_sc else None
+            })
+
+        if _db_pool.max_join_depth is not None:
+            if _join_depth([group["name"] for group in groups], options.get("filters")) > _db_pool.max_join_depth:
+                raise HTTPException(status_code=400, detail="Linked fields are limited to %s entities deep" % _db_pool.max_join_depth)
+        filters = self._read_filters(schema_sc, request["entity"], options, permissions)
+        if filters is None:
+            return []
+
+        try:
+            async with _db_pool.stage_read(primary=await self._pinned(request["schema"], caller)) as db:
+                filter_shape, params = db.bind_filters(filters)
+                plan_key = (
+                    request["schema"],
+                    request["entity"],
+                    "aggregate",
+                    tuple((group["name"], group["bucket"]) for group in groups),
+                    tuple((aggregate["function"], aggregate["field"]) for aggregate in aggregates),
+                    filter_shape
+                )
+                plan = self.STELLAR.READ_PLANS.get(plan_key)
+                if plan is None:
+                    plan = db.plan_aggregate(entity_sc.code, groups, aggregates, filters)
+                    self.STELLAR.READ_PLANS[plan_key] = plan
+                if _db_pool.statement_timeout:
+                    await db.limit_statements(_db_pool.statement_timeout)
+                rows = await db.aggregate_plan(plan, params)
+        except QueryCanceled:
+            raise HTTPException(status_code=503, detail="Aggregate took too long and was cancelled, narrow it down (filters, group_by)")
+
+        return [
+            {group["name"]: row["_ss_g%s" % i] for i, group in enumerate(groups)}
+            | {aggregate["name"]: row["_ss_a%s" % i] for i, aggregate in enumerate(aggregates)}
+            for row in rows
+        ]
+
+
+    async def facets(self, request, permissions, caller=None):
+        """
+        Count the records matching a set of filters for every distinct value of some fields at once,
+        in a single pass over the entity, e.g. for filter sidebars.
+        Filters and permissions are handled exactly as for _read.
+        Expected format:
+        {
+            "schema": Schema code,
+            "entity": Entity code,
+            "facets": {
+                "fields": [<LIST, BOOL or ENTITY field>, etc...],
+                "filters": Filter set, same as _read (OPTIONAL)
+                "show_archived": Same as _read (OPTIONAL)
+            }
+        }
+        Values of entity fields are the linked records, e.g.
+        {
+            "status": [{"value": "final", "count": 12}, etc...],
+            "department": [{"value": {"type": "Department", "uid": 3, "code": "anim"}, "count": 7}, {"value": None, "count": 2}]
+        }
+
+        :param dict request: facets request
+        :param set permissions: user permissions
+        :param str caller: login of the user, see _pinned
+
+        :returns: values of every field with their counts, most common first
+        :rtype: dict
+
+        :raises HTTPException: 400 if malformed
+        """
+        schema_sc = self.STELLAR.STELLAR[request["schema"]].entities
+        entity_sc = schema_sc[request["entity"]]
+        _db_pool = self.data[request["schema"]]
+        options = request.get("facets") or {}
+
+        if not options.get("fields") or not isinstance(options["fields"], list):
+            raise HTTPException(status_code=400, detail="Expected a list of fields")
+        facets = []
+        for field in options["fields"]:
+            field_sc = entity_sc.fields.get(field) if isinstance(field, str) else None
+            if not field_sc or field_sc.type not in FACET_FIELD_TYPES:
+                raise HTTPException(status_code=400, detail="Cannot count values of %s, only %s fields" % (field, ", ".join(FACET_FIELD_TYPES)))
+            targets = []
+            if field_sc.type == "ENTITY":
+                for ftype, rel_config in field_sc.params["constraints"].items():
+                    targets.append({
+                        "relation": rel_config["relation"],
+                        "table": entity_sc.code,
+                        "col": field_sc.code,
+                        "ftable": schema_sc[ftype].code,
+                        "display": schema_sc[ftype].display_name_col,
+                        "type": ftype
+                    })
+            facets.append({"field": field_sc.code, "targets": targets})
+
+        filters = self._read_filters(schema_sc, request["entity"], options, permissions)
+        if filters is None:
+            return {facet["field"]: [] for facet in facets}
+
+        try:
+            async with _db_pool.stage_read(primary=await self._pinned(request["schema"], caller)) as db:
+                filter_shape, params = db.bind_filters(filters)
+                plan_key = (request["schema"], request["entity"], "facets", tuple(facet["field"] for facet in facets), filter_shape)
+                plan = self.STELLAR.READ_PLANS.get(plan_key)
+                if plan is None:
+                    plan = db.plan_facets(entity_sc.code, facets, filters)
+                    self.STELLAR.READ_PLANS[plan_key] = plan
+                if _db_pool.statement_timeout:
+                    await db.limit_statements(_db_pool.statement_timeout)
+                rows = await db.aggregate_plan(plan, params)
+        except QueryCanceled:
+            raise HTTPException(status_code=503, detail="Facets took too long and were cancelled, narrow them down (filters, fields)")
+
+        resp = {facet["field"]: [] for facet in facets}
+        for row in rows:
+            for i, facet in enumerate(facets):
+                if row["_ss_in%s" % i] != 0:
+                    continue
+                value = row.get("_ss_f%s" % i)
+                for k, target in enumerate(facet["targets"]):
+                    if row["_ss_f%s_%s_uid" % (i, k)] is not None:
+                        value = {
+                            "type": target["type"],
+                            "uid": row["_ss_f%s_%s_uid" % (i, k)],
+                            target["display"]: row["_ss_f%s_%s_display" % (i, k)]
+                        }
+                resp[facet["field"]].append({"value": value, "count": row["_ss_count"]})
+                break
+        for values in resp.values():
+            values.sort(key=lambda value: value["count"], reverse=True)
+        return resp
+
+
+    async def _limit_read(self, db, request, plan, params, pagination=None, page=1):
+        """
+        Apply the DB's read limits (see README) to a staged read, before it runs.
+        - statement_timeout: the DB cancels the read past it, see read
+        - max_read_cost: the read is rejected outright if the query planner expects it to cost more
+
+        :param db._database.Database db: staged DB connection
+        :param dict request: read request, see _read
+        :param ReadPlan plan: compiled read
+        :param list params: bound filter values
+        :param int pagination: entries per page, None for streams
+        :param int page: page to read
+
+        :raises HTTPException: 400 if the read is too expensive, or asks for looser limits
+        """
+        _db_pool = self.data[request["schema"]]
+        statement_timeout = _tightest(_db_pool.statement_timeout, request["read"].get("statement_timeout"), "statement_timeout")
+        if statement_timeout:
+            await db.limit_statements(statement_timeout)
+        max_cost = _tightest(_db_pool.max_read_cost, request["read"].get("max_cost"), "max_cost")
+        if max_cost:
+            cost = await db.cost_plan(plan, params, pagination=pagination, page=page)
+            if cost > max_cost:
+                raise HTTPException(
+                    status_code=400,
+                    detail="Read too expensive (estimated cost %s, limit %s), narrow it down (filters, pagination, return_fields)" % (cost, max_cost)
+                )
+
+
+    def _plan_read(self, db, request, permissions):
+        """
+        Shared setup of every flavour of read. Resolves the filters (archival, permissions and
+        requested) and fetches the compiled plan for the read's shape, compiling it if needed.
+
+        :param db._database.Database db: staged DB connection
+        :param dict request: read request, see _read
+        :param set permissions: user permissions
+
+        :returns: compiled read plan and the filter values to bind to it, None if the user may not
+                  read this entity at all
+        :rtype: tuple|None
+
+        :raises HTTPException: 400 if the read goes past the DB's max_pagination or max_join_depth
         """
         # Helpers for syntax
         schema_sc = self.STELLAR.STELLAR[request["schema"]].entities
-        table_sc = schema_sc[request["entity"]].fields
+        _db_pool = self.data[request["schema"]]
+
+        if _db_pool.max_pagination and (request["read"].get("pagination") or 25) > _db_pool.max_pagination:
+            raise HTTPException(status_code=400, detail="pagination is limited to %s" % _db_pool.max_pagination)
+        if _db_pool.max_join_depth is not None:
+            # Every linked entity hop is another join (or semi-join) per record
+            join_depth = _join_depth(request["read"].get("return_fields", []), request["read"].get("filters"))
+            if join_depth > _db_pool.max_join_depth:
+                raise HTTPException(status_code=400, detail="Linked fields are limited to %s entities deep" % _db_pool.max_join_depth)
+
+        filters = self._read_filters(schema_sc, request["entity"], request["read"], permissions)
+        if filters is None:
+            return None
+
+        # Ensure return_fields exists
+        requested_return_fields = request["read"].get("return_fields", [])
+        if "uid" not in requested_return_fields:
+            requested_return_fields.append("uid")
+        if schema_sc[request["entity"]].display_name_col not in requested_return_fields:
+            requested_return_fields.append(schema_sc[request["entity"]].display_name_col)
+
+        order = request["read"].get("order") or "uid"
+        relevance = request["read"].get("relevance")
+        if relevance:
+            relevance_sc = schema_sc[request["entity"]].fields.get(relevance)
+            if not relevance_sc or relevance_sc.type != "SEARCH":
+                raise HTTPException(status_code=400, detail="Cannot sort by relevance of %s, not a SEARCH field" % relevance)
+            if request["read"].get("cursor"):
+                # Relevance can't be seeked from
+                raise HTTPException(status_code=400, detail="Cannot use a cursor when sorting by relevance")
+        if request["read"].get("cursor") and order not in requested_return_fields:
+            # The order value of the last record is half of the next keyset cursor
+            requested_return_fields.append(order)
+
+        # Reads of the same shape compile to the same SQL, only the filter values change.
+        # Plans are dropped by STELLAR whenever the schema changes.
+        filter_shape, params = db.bind_filters(filters)
+        plan_key = (request["schema"], request["entity"], tuple(sorted(set(requested_return_fields))), order, relevance, filter_shape)
+        plan = self.STELLAR.READ_PLANS.get(plan_key)
+        if plan is None:
+            try:
+                plan = db.plan_read(
+                    table=schema_sc[request["entity"]].code,
+                    fields=self._build_return_field_set(schema_sc, request["entity"], requested_return_fields),
+                    filters=filters,
+                    order=order,
+                    relevance=relevance
+                )
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            self.STELLAR.READ_PLANS[plan_key] = plan
+        return plan, params
+
+
+    def _read_filters(self, schema_sc, entity, options, permissions):
+        """
+        Every filter a read has to go through: archival, permissions and requested, resolved.
+
+        :param dict schema_sc: STELLAR entities of the schema being read
+        :param str entity: entity being read
+        :param dict options: read options ("filters" and "show_archived")
+        :param set permissions: user permissions
 
+        :returns: resolved filters, None if the user may not read this entity at all
+        :rtype: dict|None
+        """
         # Preformatting default archived filter
-        filters = _DEFAULT_QUERY_FILTER(request)
+        filters = _DEFAULT_QUERY_FILTER(options)
         # Fetch relevant permission filters
         # Permission ID 1 is admin (hard-coded, TODO?)
         if 1 not in permissions:
-            permissionRules = schema_sc[request["entity"]].parse_permissions(permissions)
+            permissionRules = schema_sc[entity].parse_permissions(permissions)
             print(permissionRules)
             if permissionRules:
                 filters["filters"].extend(permissionRules)
             elif permissionRules == False:  # IMPORTANT if no permissions explicitely defined, RETURN NOTHING. zero-trust
-                return []
+                return None
 
-        if request["read"].get("filters"):
-            filters["filters"].append(request["read"]["filters"])
+        if options.get("filters"):
+            filters["filters"].append(options["filters"])
+        # Linked field filters (dot-paths) need to know which relations to go through
+        return self._resolve_filters(schema_sc, entity, filters)
 
-        # Setup default structures
-        return_fields = ReturnFieldSet(schema_sc[request["entity"]].code, None, [])
 
-        # Ensure return_fields exists
-        requested_return_fields = request["read"].get("return_fields", [])
-        if "uid" not in requested_return_fields:
-            requested_return_fields.append("uid")
-        if schema_sc[request["entity"]].display_name_col not in requested_return_fields:
-            requested_return_fields.append(schema_sc[request["entity"]].display_name_col)
+    def _resolve_filters(self, schema_sc, entity, filters):
+        """
+        Resolve any filter on a linked field through STELLAR, so it can be compiled to a semi-join.
+        Linked fields use the same dot-path syntax as return fields, e.g.
+            ["assets.Asset.status", "is", "final"]
+        becomes
+            ["assets.Asset.status", "is", "final", {"field": "status", "links": [<relation>]}]
+        See db.psql._build_exists for the link format.
+        Filters on SEARCH fields (linked or not) also carry the field's language, which searches
+        have to be parsed with, e.g.
+            ["search", "matches", "red car"]
+        becomes
+            ["search", "matches", "red car", {"language": "english"}]
+
+        :param dict schema_sc: STELLAR entities of the schema being read
+        :param str entity: entity being read
+        :param dict filters: Railgun filters
+
+        :returns: resolved copy of the filters
+        :rtype: dict
+
+        :raises HTTPException: 400 if a dot-path doesn't lead anywhere
+        """
+        resolved = []
+        for subfilter in filters["filters"]:
+            if isinstance(subfilter, dict):
+                resolved.append(self._resolve_filters(schema_sc, entity, subfilter))
+            elif "." in subfilter[0]:
+                linked_field = subfilter[0].split(".")
+                if len(linked_field)%2 != 1:
+                    raise HTTPException(status_code=400, detail="Malformed linked filter field: %s" % subfilter[0])
+                links, field_sc = self._resolve_links(schema_sc, entity, linked_field)
+                if not field_sc or field_sc.type in ("ENTITY", "MULTIENTITY"):
+                    raise HTTPException(status_code=400, detail="Cannot filter through %s" % subfilter[0])
+                resolved.append([*subfilter[:3], {"field": linked_field[-1], "links": links} | _search_language(field_sc)])
+            elif (field_sc := schema_sc[entity].fields.get(subfilter[0])) and field_sc.type == "SEARCH":
+                resolved.append([*subfilter[:3], _search_language(field_sc)])
+            else:
+                resolved.append(subfilter)
+        return filters | {"filters": resolved}
+
+
+    def _resolve_links(self, schema_sc, entity, linked_field):
+        """
+        Follow a linked field's dot-path through STELLAR, see _resolve_filters for the link format.
+
+        :param dict schema_sc: STELLAR entities of the schema
+        :param str entity: entity the path starts from
+        :param list linked_field: dot-path, split
+
+        :returns: links to go through and the STELLAR field the path ends on, None if it doesn't lead anywhere
+        :rtype: list, Field|None
+        """
+        links = []
+        current = entity
+        for i in range(0, len(linked_field)-1, 2):
+            field_sc = schema_sc[current].fields.get(linked_field[i])
+            if not field_sc or field_sc.type not in ("ENTITY", "MULTIENTITY") or linked_field[i+1] not in field_sc.params["constraints"]:
+                return links, None
+            links.append({
+                "relation": field_sc.params["constraints"][linked_field[i+1]]["relation"],
+                "table": schema_sc[current].code,
+                "col": linked_field[i],
+                "ftable": schema_sc[linked_field[i+1]].code,
+                "type": field_sc.type
+            })
+            current = linked_field[i+1]
+        return links, schema_sc[current].fields.get(linked_field[-1])
+
+
+    def _build_return_field_set(self, schema_sc, entity, requested_return_fields):
+        """
+        Build the ReturnFieldSet of a read from the requested field codes and dot-paths.
+        This is the expensive part of compiling a read, only done when no read plan is cached.
+
+        :param dict schema_sc: STELLAR entities of the schema being read
+        :param str entity: entity being read
+        :param list requested_return_fields: field codes and linked field dot-paths to return
+
+        :returns: return fields of the read
+        :rtype: ReturnFieldSet
+        """
+        table_sc = schema_sc[entity].fields
+        # Setup default structures
+        return_fields = ReturnFieldSet(schema_sc[entity].code, None, [])
 
         # Always include base type
-        return_fields.put(PresetReturnField("type", request["entity"]))
+        return_fields.put(PresetReturnField("type", entity))
 
         for field in requested_return_fields:
             if "." in field:
@@ -142,7 +1010,7 @@ class Railgun(FastAPI):
 
                 # Parse linked fields recursively for arbitrary depth
                 return_fields.put(
-                    self._linked_return_field_builder(linked_field, 0, schema_sc, request["entity"])
+                    self._linked_return_field_builder(linked_field, 0, schema_sc, entity)
                 )
             else:
                 # TODO review this
@@ -151,22 +1019,10 @@ class Railgun(FastAPI):
                 #    preset_return_fields[field] = "********"
                 #    continue
                 return_fields.put(table_sc[field].return_field)
-
-        resp = await db.query(
-            table=schema_sc[request["entity"]].code,
-            fields=return_fields,
-            filters=filters,
-            pagination=request["read"].get("pagination") or 25,
-            page=request["read"].get("page") or 1,
-            order=request["read"].get("order") or "uid"
-        )
-        if bool(request["read"].get("include_count", False)):
-            query_total_count = await db.count(schema_sc[request["entity"]].code, filters)
-            resp.append(query_total_count)
-        return resp
+        return return_fields
 
 
-    async def batch(self, request, permissions=None):
+    async def batch(self, request, permissions=None, caller=None):
         """
         Create - Update - Delete
 
@@ -180,27 +1036,34 @@ class Railgun(FastAPI):
         {
             "schema": <schema>,
             "batch": [{
-                "request_type": "create"|"update"|"delete",
+                "request_type": "create"|"update"|"upsert"|"delete"|"update_where"|"archive_where",
                 "entity": <entity>,
+                > IF "upsert"
+                "conflict": <unique field identifying the record, see upsert>,
                 > IF "update"|"delete"
                 "entity_id": <id of entity to update>,
                 "permanent": <delete completely or only archive>
-                > IF "create"|"update"
+                > IF "create"|"update"|"upsert"|"update_where"
                 "data": {
                     <field>: <value>,
                     etc...
                 }
+                > IF "update_where"|"archive_where", see _update_where
+                "filters": Filter set, same as _read,
+                "show_archived": Same as _read (OPTIONAL, update_where only),
+                "count_only": <only return how many records were affected> (OPTIONAL)
             },etc...
             ]
         }
-        While it's in fact quite inefficient, Railgun processes each request individually.
-        This can in fact end up causing performance concerns in production depenting on how
-        the software is used. TODO (batch also needs a refactor related to [table])
-
-        Just don't use it the bad way 4head.
+        Consecutive creates of the same entity setting the same fields are inserted together,
+        see _create_many. Every other request is still processed individually, but pipelined:
+        statements are sent without waiting for the previous ones to finish unless their result is needed
+        (uids of created records to link, stored links to diff). Everything else is fetched at the end.
+        TODO (batch also needs a refactor related to [table])
 
         :param dict request: CUD batch request
-        :param set permissions: user permissions (TODO)
+        :param set permissions: user permissions, only enforced by update_where/archive_where (TODO)
+        :param str caller: login of the user, see _pinned
 
         :returns: list of entities effected by the operation
         :rtype: list[dict]
@@ -208,28 +1071,58 @@ class Railgun(FastAPI):
         try:
             return_values = []
             assert "batch" in request
+            written = set()
             _db_pool = self.data[request["schema"]]
             async with _db_pool.stage() as db:
-                for op in request["batch"]:
-                    # We'll need to pass the actual table to the DB regardless of the operation
-                    op["table"] = self.STELLAR.STELLAR[request["schema"]].entities[op["entity"]].code
-                    op["schema"] = request["schema"]
-                    # Process updates
-                    if op["request_type"] == "update":
-                        return_values.append(await self._update(db, op))
-
-                    # Process creates
-                    elif op["request_type"] == "create":
-                        return_values.append(await self._create(db, op))
-
-                    # Process deletes
-                    elif op["request_type"] == "delete":
-                        return_values.append(await self._delete(db, op))
-
-                    else:
-                        raise CUDError("Unrecognized request type: %s" % op["request_type"])
-
-        except (AssertionError, CUDError, KeyError) as cude:
+                # Statements are queued up without waiting on the DB, unless a result is needed to go on.
+                # COPY can't run in a pipeline, batches large enough to use it wouldn't gain much anyway.
+                async with nullcontext() if _uses_copy(request["batch"], _db_pool.copy_threshold) else db.pipeline():
+                    creates = []  # (op, relations) of the create group being built up
+                    for op in request["batch"]:
+                        # We'll need to pass the actual table to the DB regardless of the operation
+                        op["table"] = self.STELLAR.STELLAR[request["schema"]].entities[op["entity"]].code
+                        op["schema"] = request["schema"]
+                        written |= self._written_tables(op)
+                        if op["request_type"] == "create":
+                            # Relations are popped out of the data, only the columns left decide the group
+                            create_rel = self._op_middleware(op)
+                            if creates and (creates[0][0]["entity"], creates[0][0]["data"].keys()) != (op["entity"], op["data"].keys()):
+                                return_values.extend(await self._create_many(db, creates, deferred=True))
+                                creates = []
+                            creates.append((op, create_rel))
+                            continue
+                        if creates:
+                            return_values.extend(await self._create_many(db, creates, deferred=True))
+                            creates = []
+
+                        # Process updates
+                        if op["request_type"] == "update":
+                            return_values.append(await self._update(db, op, deferred=True))
+
+                        # Process upserts
+                        elif op["request_type"] == "upsert":
+                            return_values.append(await self._upsert(db, op, deferred=True))
+
+                        # Process deletes
+                        elif op["request_type"] == "delete":
+                            return_values.append(await self._delete(db, op, deferred=True))
+
+                        # Process bulk updates and archivals
+                        elif op["request_type"] in ("update_where", "archive_where"):
+                            return_values.append(await self._update_where(db, op, permissions))
+
+                        else:
+                            raise CUDError("Unrecognized request type: %s" % op["request_type"])
+                    if creates:
+                        return_values.extend(await self._create_many(db, creates, deferred=True))
+                    # Results nothing depended on are only fetched now, in one go
+                    for i, result in enumerate(return_values):
+                        if isinstance(result, AsyncCursor):
+                            return_values[i] = await result.fetchone()
+            await self._written(request["schema"], written, caller)
+
+        # Deferred upserts only find out their unique index is missing once fetched, see PSQL.upsert
+        except (AssertionError, CUDError, KeyError, InvalidColumnReference) as cude:
             raise HTTPException(
                 status_code=500,
                 detail=str(type(cude)) + " " + str(cude) + "\nAll operations rolled back."
@@ -237,7 +1130,7 @@ class Railgun(FastAPI):
         return return_values
 
 
-    async def create(self, request, permissions=None):
+    async def create(self, request, permissions=None, caller=None):
         """
         Railgun CRUD - Create. Create a record.
         Request format is expected as:
@@ -251,14 +1144,17 @@ class Railgun(FastAPI):
 
         :param dict request: creation request
         :param set permissions: user permissions (TODO)
+        :param str caller: login of the user, see _pinned
 
         :returns: entity that was created
         :rtype: dict
         """
         _db_pool = self.data[request["schema"]]
         request["table"] = self.STELLAR.STELLAR[request["schema"]].entities[request["entity"]].code
+        written = self._written_tables(request)
         async with _db_pool.stage() as db:
             result = await self._create(db, request)
+        await self._written(request["schema"], written, caller)
         return result
 
     async def _create(self, db, op, permissions=None):
@@ -267,30 +1163,80 @@ class Railgun(FastAPI):
         create_rel = self._op_middleware(op)
 
         created = await db.create(op)
-        for ftu in create_rel:  # TODO sucks that we have to iterate over these essentially twice
-            for newrel in ftu["data"]:
-                rel_config = ftu["sf"].params["constraints"][newrel["type"]]
-                if self.STELLAR.STELLAR[op["schema"]].entities[newrel["type"]].fields[rel_config["col"]].type == "ENTITY":
-                    # We need to wipe other foreign field relations too if the foreign field we're updating is a single-entity field,
-                    # to make sure there's only one. Have to do this in the create relation part as we only want to delete it if we're
-                    # replacing it with something.
-                    for fdelrel in self.STELLAR.STELLAR[op["schema"]].entities[newrel["type"]].fields[rel_config["col"]].params["constraints"].values():
-                        await db.delete_relation(
-                            fdelrel["relation"],
-                            self.STELLAR.STELLAR[op["schema"]].entities[newrel["type"]].code,
-                            rel_config["col"],
-                            newrel["uid"]
-                        )
-                await db.create_relation(
-                    rel_config["relation"],
-                    self.STELLAR.STELLAR[op["schema"]].entities[op["entity"]].code,
-                    rel_config["table"],
-                    (ftu["sf"].code, created["uid"], newrel["uid"], rel_config["col"])
-                )
+        for ftu in create_rel:  # There's nothing to remove on a new record
+            await self._link(db, op, created["uid"], ftu["sf"], _link_sets(ftu.get("data", ftu.get("add"))))
+        return created
+
+    async def _create_many(self, db, creates, deferred=False):
+        """
+        Create a group of records of the same entity, all setting the same fields, in one go.
+        Their middleware must already have run.
+
+        :param psycopg.AsyncConnection db: staged connection
+        :param list[tuple] creates: (create operation, relations returned by _op_middleware) of every record
+        :param bool deferred: leave the cursors of records created alone without relations, see batch
+
+        :returns: entities created, in the same order as creates
+        :rtype: list[dict|psycopg.AsyncCursor]
+        """
+        first = creates[0][0]
+        if len(creates) == 1 or not first["data"]:
+            # Nothing to gain, or no columns to insert in bulk
+            created = [await db.create(op, deferred=deferred and not create_rel) for op, create_rel in creates]
+        else:
+            fields = list(first["data"].keys())
+            created = await db.create_many(
+                first["table"],
+                first["entity"],
+                fields,
+                [tuple(op["data"][field] for field in fields) for op, _ in creates],
+                copy=len(creates) >= self.data[first["schema"]].copy_threshold
+            )
+        for (op, create_rel), record in zip(creates, created):
+            for ftu in create_rel:
+                await self._link(db, op, record["uid"], ftu["sf"], _link_sets(ftu.get("data", ftu.get("add"))))
         return created
 
+    async def _link(self, db, op, uid, sf, links):
+        """
+        Link a record to entities on one of its entity fields.
+        Every relation table is written with one statement, rather than one per link.
+
+        :param psycopg.AsyncConnection db: staged connection
+        :param dict op: create or update operation
+        :param int uid: uid of the record being linked
+        :param Field sf: entity field being set
+        :param dict links: entities to link to, see _link_sets
+        """
+        schema_sc = self.STELLAR.STELLAR[op["schema"]]
+        for ftype, fuids in links.items():
+            if not fuids:
+                continue
+            rel_config = sf.params["constraints"][ftype]
+            foreign_field = schema_sc.entities[ftype].fields[rel_config["col"]]
+            if foreign_field.type == "ENTITY":
+                # We need to wipe other foreign field relations too if the foreign field we're updating is a single-entity field,
+                # to make sure there's only one. Have to do this in the create relation part as we only want to delete it if we're
+                # replacing it with something.
+                for fdelrel in foreign_field.params["constraints"].values():
+                    await db.delete_relations(
+                        fdelrel["relation"],
+                        schema_sc.entities[ftype].code,
+                        rel_config["col"],
+                        list(fuids)
+                    )
+            await db.create_relations(
+                rel_config["relation"],
+                op["table"],
+                rel_config["table"],
+                sf.code,
+                uid,
+                rel_config["col"],
+                list(fuids)
+            )
+
 
-    async def update(self, request, permissions=None):
+    async def update(self, request, permissions=None, caller=None):
         """
         Railgun CRUD - Update. Update a record.
         Request format is expected as:
@@ -305,58 +1251,162 @@ class Railgun(FastAPI):
 
         :param dict request: update request
         :param set permissions: user permissions (TODO)
+        :param str caller: login of the user, see _pinned
 
         :returns: entity that was updated
         :rtype: dict
         """
         _db_pool = self.data[request["schema"]]
         request["table"] = self.STELLAR.STELLAR[request["schema"]].entities[request["entity"]].code
+        written = self._written_tables(request)
         async with _db_pool.stage() as db:
             result = await self._update(db, request)
+        await self._written(request["schema"], written, caller)
         return result
 
-    async def _update(self, db, op, permissions=None):
+    async def _update(self, db, op, permissions=None, deferred=False):
         # Perform any data manipualtions needed, and
         # set up any relations we may need to add (entity field updates pepehands)
         update_rel = self._op_middleware(op)
 
         if op["data"]:  # We only need to do a "normal" update if there's non-relation things to update
-            updated = await db.update(op)
+            # Deferred, the result is a cursor to fetch once the batch is done
+            updated = await db.update(op, deferred=deferred)
         else:
             # Still set a return dict for updated ops, even if we only changed relations
             updated = {"type": op["entity"], "uid": op["entity_id"]}
+        uid = int(op["entity_id"])
 
-        for ftu in update_rel:  # TODO sucks that we have to iterate over these essentially twice
-            for delrel in ftu["sf"].params["constraints"].values():
-                await db.delete_relation(
-                    delrel["relation"],
-                    self.STELLAR.STELLAR[op["schema"]].entities[op["entity"]].code,
-                    ftu["sf"].code,
-                    op["entity_id"]
-                )
-            for newrel in ftu["data"]:
-                rel_config = ftu["sf"].params["constraints"][newrel["type"]]
-                if self.STELLAR.STELLAR[op["schema"]].entities[newrel["type"]].fields[rel_config["col"]].type == "ENTITY":
-                    # We need to wipe other foreign field relations too if the foreign field we're updating is a single-entity field,
-                    # to make sure there's only one. Have to do this in the create relation part as we only want to delete it if we're
-                    # replacing it with something.
-                    for fdelrel in self.STELLAR.STELLAR[op["schema"]].entities[newrel["type"]].fields[rel_config["col"]].params["constraints"].values():
-                        await db.delete_relation(
-                            fdelrel["relation"],
-                            self.STELLAR.STELLAR[op["schema"]].entities[newrel["type"]].code,
-                            rel_config["col"],
-                            newrel["uid"]
-                        )
-                await db.create_relation(
-                    rel_config["relation"],
-                    self.STELLAR.STELLAR[op["schema"]].entities[op["entity"]].code,
-                    rel_config["table"],
-                    (ftu["sf"].code, updated["uid"], newrel["uid"], rel_config["col"])
-                )
+        await self._relink(db, op, uid, update_rel)
         return updated
 
 
-    async def delete(self, request, permissions=None):
+    async def _relink(self, db, op, uid, rels):
+        """
+        Set the links of an existing record's entity fields.
+        Only the difference between the links stored and the ones requested is written.
+
+        :param psycopg.AsyncConnection db: staged connection
+        :param dict op: update or upsert operation
+        :param int uid: uid of the record being linked
+        :param list[dict] rels: relations returned by _op_middleware
+        """
+        for ftu in rels:
+            constraints = ftu["sf"].params["constraints"]
+            stored = {
+                ftype: set(await db.read_relations(rel_config["relation"], op["table"], rel_config["table"], ftu["sf"].code, uid))
+                for ftype, rel_config in constraints.items()
+            }
+            if "data" in ftu:
+                wanted = _link_sets(ftu["data"])
+                removed = {ftype: [fuid for fuid in fuids if fuid not in wanted.get(ftype, {})] for ftype, fuids in stored.items()}
+            else:
+                wanted = _link_sets(ftu["add"])
+                removed = {ftype: [fuid for fuid in fuids if fuid in stored[ftype]] for ftype, fuids in _link_sets(ftu["remove"]).items()}
+            for ftype, fuids in removed.items():
+                if fuids:
+                    await db.remove_relations(
+                        constraints[ftype]["relation"],
+                        op["table"],
+                        constraints[ftype]["table"],
+                        ftu["sf"].code,
+                        uid,
+                        fuids
+                    )
+            added = {ftype: {fuid: None for fuid in fuids if fuid not in stored[ftype]} for ftype, fuids in wanted.items()}
+            await self._link(db, op, uid, ftu["sf"], added)
+
+
+    async def upsert(self, request, permissions=None, caller=None):
+        """
+        Railgun CRUD - Upsert. Create a record, or update the one that has the same value on a unique field.
+        Request format is expected as:
+        {
+            "schema": <schema>,
+            "entity": <entity>,
+            "conflict": <unique field identifying the record, must be in data>,
+            "data": {
+                <field>: <value>
+            }
+        }
+
+        :param dict request: upsert request
+        :param set permissions: user permissions (TODO)
+        :param str caller: login of the user, see _pinned
+
+        :returns: entity that was created or updated
+        :rtype: dict
+
+        :raises HTTPException: 400 if the conflict field isn't uniquely indexed
+        """
+        _db_pool = self.data[request["schema"]]
+        request["table"] = self.STELLAR.STELLAR[request["schema"]].entities[request["entity"]].code
+        written = self._written_tables(request)
+        try:
+            async with _db_pool.stage() as db:
+                result = await self._upsert(db, request)
+        except CUDError as cude:
+            raise HTTPException(status_code=400, detail=str(cude))
+        await self._written(request["schema"], written, caller)
+        return result
+
+    async def _upsert(self, db, op, permissions=None, deferred=False):
+        field_sc = self.STELLAR.STELLAR[op["schema"]].entities[op["entity"]].fields.get(op.get("conflict"))
+        # Only a ready unique index lets ON CONFLICT find the existing record
+        index = ((field_sc.params or {}).get("index") or {}) if field_sc else {}
+        if not (field_sc and field_sc.index and index.get("unique")):
+            raise CUDError("Upserts need a uniquely indexed conflict field, %s is not one" % op.get("conflict"))
+        if op["data"].get(op["conflict"]) is None:
+            raise CUDError("Upserts need a value for their conflict field %s" % op["conflict"])
+        upsert_rel = self._op_middleware(op)
+
+        # Deferred, the result is a cursor to fetch once the batch is done
+        upserted = await db.upsert(op, op["conflict"], index["partial"], deferred=deferred and not upsert_rel)
+        if upsert_rel:
+            await self._relink(db, op, upserted["uid"], upsert_rel)
+        return upserted
+
+
+    async def _update_where(self, db, op, permissions=None):
+        """
+        Update or archive every record matching a set of filters, in a single UPDATE.
+        Filters and permissions are handled exactly as for _read, a user can only touch the records
+        they can read. Only plain fields can be set: no entity fields, and no media fields since
+        their files are managed per record.
+        archive_where ignores data and show_archived, it archives records that aren't yet.
+
+        :param psycopg.AsyncConnection db: staged connection
+        :param dict op: update_where or archive_where operation
+        :param set permissions: user permissions
+
+        :returns: type-uid dicts of the records affected, or {"type": <entity>, "count": <int>} if count_only
+        :rtype: list[dict]|dict
+
+        :raises CUDError: if malformed
+        """
+        schema_sc = self.STELLAR.STELLAR[op["schema"]].entities
+        if op["request_type"] == "archive_where":
+            op["data"] = {"_ss_archived": True}
+            op["show_archived"] = False
+        if not op.get("filters"):
+            # Too easy to get wrong, filter on the archival status explicitly to go through everything
+            raise CUDError("%s needs filters" % op["request_type"])
+        if not op.get("data"):
+            raise CUDError("update_where needs data")
+        for field in op["data"]:
+            if field != "_ss_archived" and schema_sc[op["entity"]].fields[field].type in ("ENTITY", "MULTIENTITY", "MEDIA"):
+                raise CUDError("update_where can't set %s fields: %s" % (schema_sc[op["entity"]].fields[field].type, field))
+        self._op_middleware(op)  # Nothing relational left, only validation and conversions
+
+        filters = self._read_filters(schema_sc, op["entity"], op, permissions or set())
+        if filters is None:
+            # The user can't see a single record of this entity
+            return {"type": op["entity"], "count": 0} if op.get("count_only") else []
+        _, params = db.bind_filters(filters)
+        return await db.update_where(op["table"], op["entity"], op["data"], filters, params, bool(op.get("count_only")))
+
+
+    async def delete(self, request, permissions=None, caller=None):
         """
         Railgun CRUD - Delete. Delete a record.
         Request format is expected as:
@@ -369,17 +1419,20 @@ class Railgun(FastAPI):
 
         :param dict request: deletion request
         :param set permissions: user permissions (TODO)
+        :param str caller: login of the user, see _pinned
 
         :returns: entity that was deleted
         :rtype: dict
         """
         _db_pool = self.data[request["schema"]]
         request["table"] = self.STELLAR.STELLAR[request["schema"]].entities[request["entity"]].code
+        written = self._written_tables(request)
         async with _db_pool.stage() as db:
             result = await self._delete(db, request)
+        await self._written(request["schema"], written, caller)
         return result
 
-    async def _delete(self, db, op, permissions=None):
+    async def _delete(self, db, op, permissions=None, deferred=False):
         if bool(op.get("permanent", False)):  # Some hubris to allow proper parsing of false values
             result = await db.delete(op)
             # Delete any files
@@ -389,11 +1442,11 @@ class Railgun(FastAPI):
                 shutil.rmtree(ent_file_dir)
         else:
             op["data"] = {"_ss_archived": True}
-            result = await self._update(db, op)
+            result = await self._update(db, op, deferred=deferred)
         return result
 
 
-    async def upload_file(self, filepath, filename, metadata, permissions=None):
+    async def upload_file(self, filepath, filename, metadata, permissions=None, caller=None):
         """
         Save uploaded file to correct formatted location on-disk and
         update the record's FILE type field with the path str.
@@ -408,6 +1461,7 @@ class Railgun(FastAPI):
             "field": <FILE type field>
         }
         :param set permissions: user permissions (TODO)
+        :param str caller: login of the user, see _pinned
         """
         if metadata["schema"] not in self.data:
             raise Exception("Schema %s not known" % metadata["schema"])
@@ -446,6 +1500,7 @@ class Railgun(FastAPI):
         # Also validate that the target entity actually (still/ever did) exists
         if not update:
             raise Exception("There is no entity %s - %s" % (metadata["type"], metadata["uid"]))
+        await self._written(metadata["schema"], {entcode}, caller)
 
         # Make sure the file directory exists
         absolute_final_path.parent.mkdir(parents=True, exist_ok=True)
@@ -560,6 +1615,14 @@ class Railgun(FastAPI):
         """
         try:
             assert "part" in request and "request_type" in request and "schema" in request and request["schema"] in self.data
+            if request["part"] == "schema" and request["request_type"] == "index_relations":
+                # Maintenance, indexes every relation table of the schema that isn't yet.
+                # Built concurrently, outside of any transaction.
+                self._build_in_background(
+                    (request["schema"], None, None),
+                    self.STELLAR.index_relations(self.data[request["schema"]], request["schema"])
+                )
+                return None
             # TODO permissions monkaS
             # Use the db and stellardb contexts. If the DB fails, we don't need to commit to stellar.
             # If stellar fails, the physical entries still exist, but in that very edge case, we can deal with it manually much more easily.
@@ -570,6 +1633,12 @@ class Railgun(FastAPI):
             if comet:
                 # Stellar Stellar
                 await self.STELLAR.shoot_for_the_stars(comet)
+            if request["part"] == "field" and "index" in request["data"]:
+                # Indexes are built concurrently once the field is committed, which can take a while on big tables
+                self._build_in_background(
+                    (request["schema"], request["entity"], request["data"]["code"]),
+                    self.STELLAR.index_field(self.data[request["schema"]], request)
+                )
         except NotImplementedError:
             resp = "NYI"
         except AssertionError:
@@ -582,6 +1651,46 @@ class Railgun(FastAPI):
         return None  # Explicit for visibility
 
 
+    def _build_in_background(self, build_key, build):
+        """
+        Run an index build without holding up the request that asked for it.
+        Running builds are kept track of in STELLAR.INDEX_BUILDS until they're done.
+
+        :param tuple build_key: (schema, entity, field) being indexed, entity and field None for relation tables
+        :param Coroutine build: index build to run
+        """
+        self.STELLAR.INDEX_BUILDS[build_key] = asyncio.create_task(build)
+        self.STELLAR.INDEX_BUILDS[build_key].add_done_callback(lambda _: self.STELLAR.INDEX_BUILDS.pop(build_key, None))
+
+
+    async def index_status(self, request):
+        """
+        Report the state of every index managed by Railgun on an entity's fields, with the
+        live progress of the ones being built.
+        Expected format:
+        {
+            "schema": <schema_code>,
+            "entity": <entity_code>
+        }
+
+        :param dict request: index status request
+
+        :returns: index state per field code, see StellarStellar.index_field
+        :rtype: dict
+        """
+        entity_sc = self.STELLAR.STELLAR[request["schema"]].entities[request["entity"]]
+        indexes = {}
+        async with self.data[request["schema"]].stage() as db:
+            for field in entity_sc.fields.values():
+                if not (field.params or {}).get("index"):
+                    continue
+                indexes[field.code] = field.params["index"] | {
+                    "indexed": field.index,
+                    "progress": await db.index_progress(entity_sc.code, field.code) if field.params["index"]["status"] == "building" else None
+                }
+        return indexes
+
+
     async def internal_operations(self, entity_type, operation, request, permissions):
         """
         Validator function for "always-on" authorized internal operations.
@@ -619,6 +1728,91 @@ class Railgun(FastAPI):
             self.data[db].disconnect()
 
 
+    def _written_tables(self, op):
+        """
+        Every table a CUD operation will write to, relation tables included.
+        Must be called before the operation runs, the middleware pops relation fields off its data.
+
+        :param dict op: CUD operation
+
+        :returns: table codes
+        :rtype: set
+        """
+        entities_sc = self.STELLAR.STELLAR[op["schema"]].entities
+        written = {op["table"]}
+        if bool(op.get("permanent", False)):
+            # Every relation of the record goes with it
+            op_fields = entities_sc[op["entity"]].fields.values()
+        else:
+            op_fields = [entities_sc[op["entity"]].fields[op_field] for op_field in op.get("data", {}) if op_field != "_ss_archived"]
+        for op_field in op_fields:
+            if op_field.type not in ("ENTITY", "MULTIENTITY"):
+                continue
+            for ftype, rel_config in op_field.params["constraints"].items():
+                written.add(rel_config["relation"])
+                # Single-entity foreign fields get their other relations wiped, see _create
+                ffield = entities_sc[ftype].fields.get(rel_config["col"])
+                if ffield and ffield.type == "ENTITY":
+                    written.update(fdelrel["relation"] for fdelrel in ffield.params["constraints"].values())
+        return written
+
+
+    async def _written(self, schema, tables, caller=None):
+        """
+        Drop anything cached from tables that were just written to, and pin the caller's reads to
+        the primary if need be (see _pinned). Only call once the write is committed.
+
+        :param str schema: schema written to
+        :param set tables: tables written to, see _written_tables
+        :param str caller: login of the user who wrote
+        """
+        self.STELLAR.READ_COUNTS.invalidate(schema, tables)
+        # Always, any read may ask for cached counts
+        await railcache.bump_tables(self.STELLAR.comet, schema, tables)
+        if caller and self.data[schema].replicas and self.data[schema].read_your_writes:
+            await railcache.pin_caller(self.STELLAR.comet, schema, caller, self.data[schema].read_your_writes)
+
+
+    async def _read_primary(self, request, caller, cache=True):
+        """
+        Whether a read must go to the primary rather than a replica: the caller is pinned (see _pinned),
+        or its result may get cached. Cached reads and counts are keyed on table versions bumped as soon as
+        the primary commits a write (see _written), a lagging replica could still return the old rows,
+        which would then be cached under the new versions and served by every instance.
+        Cache hits don't run anything, only misses end up on the primary.
+
+        :param dict request: read request, see _read
+        :param str caller: login of the user reading, if known
+        :param bool cache: whether the read may use the read cache, see _read
+
+        :rtype: bool
+        """
+        _db_pool = self.data[request["schema"]]
+        if not _db_pool.replicas:
+            return False
+        if cache and request["entity"] in _db_pool.read_cache:
+            return True
+        if request["read"].get("include_count") and (request["read"].get("count_strategy") or _db_pool.count_strategy) == "cached":
+            return True
+        return await self._pinned(request["schema"], caller)
+
+
+    async def _pinned(self, schema, caller):
+        """
+        Whether a caller's reads must go to the primary rather than a replica.
+        Only ever the case for a few seconds after they wrote, if the DB has "read_your_writes" set,
+        since replicas may not have caught up to their write yet. Pins are shared by every instance.
+
+        :param str schema: schema being read
+        :param str caller: login of the user reading, if known
+
+        :rtype: bool
+        """
+        if not (caller and self.data[schema].replicas and self.data[schema].read_your_writes):
+            return False
+        return await railcache.is_pinned(self.STELLAR.comet, schema, caller)
+
+
     def _op_middleware(self, op):
         """
         """
@@ -12,6 +12,7 @@ from lib.ragesync import execute_immediately
 from db import PSQL
 from config import CONFIG
 from src.structures.returnfields import ReturnField, ReturnFieldSet
+from src.structures.caches import ReadPlanCache, CountCache
 from src.structures.structure_structure import STELLARWrapper, Schema, Entity, Field, StellarUserCache, StellarUser
 
 
@@ -49,6 +50,7 @@ class StellarStellar():
                 "JSON": self._field_create_simple,
                 "BOOL": self._field_create_bool,
                 "LIST": self._field_create_list,
+                "SEARCH": self._field_create_search,
                 "ENTITY": self._field_create_entity,
                 "MULTIENTITY": self._field_create_entity
             },
@@ -62,6 +64,7 @@ class StellarStellar():
                 "JSON": self._field_update_simple,
                 "BOOL": self._field_update_simple,
                 "LIST": self._field_update_list,
+                "SEARCH": self._field_update_simple,
                 "ENTITY": self._field_update_entity,
                 "MULTIENTITY": self._field_update_entity
             },
@@ -75,6 +78,7 @@ class StellarStellar():
                 "JSON": self._field_delete_simple,
                 "BOOL": self._field_delete_simple,
                 "LIST": self._field_delete_simple,
+                "SEARCH": self._field_delete_simple,
                 "ENTITY": self._field_delete_entity,
                 "MULTIENTITY": self._field_delete_entity
             }
@@ -87,6 +91,13 @@ class StellarStellar():
             "DB_PORT": CONFIG.RAILGUN_DB_PORT
         })
 
+        # Compiled /read SQL, only valid for as long as the schema doesn't change
+        self.READ_PLANS = ReadPlanCache()
+        # Counts of include_count reads using the "cached" strategy
+        self.READ_COUNTS = CountCache()
+        # Index builds running in the background, see index_field
+        self.INDEX_BUILDS = {}
+
         # *kira kira*
         self.STELLAR = execute_immediately(self.stellar_stellar())
         self.USER_CACHE = execute_immediately(self.stellar_users())
@@ -417,6 +428,10 @@ class StellarStellar():
             )
         else:
             self.STELLAR = await self.stellar_stellar()
+        # Any compiled read may reference what just changed. Only drop plans once the new
+        # schema is live, so nothing gets recompiled against the old one.
+        self.READ_PLANS.invalidate(request.get("schema"))
+        self.READ_COUNTS.invalidate(request.get("schema"))
 
 
     async def create_field(self, request, db, stellardb):
@@ -434,7 +449,8 @@ class StellarStellar():
             "data": {
                 "code": <field_code>,
                 "name": <field_name>,
-                "type": <field_type>
+                "type": <field_type>,
+                "index": {"method": "btree"|"hash"|"trigram"|"fulltext", "partial": <bool>, "unique": <bool>} # OPTIONAL, see index_field
             }
         }
         """
@@ -442,6 +458,10 @@ class StellarStellar():
             raise NotImplementedError
         if request["data"]["code"] == "type":
             raise NotImplementedError  # TODO better error messaging
+        if request["data"]["type"] == "SEARCH":
+            # A search field is pointless without its index
+            request["data"].setdefault("index", {"method": "fulltext"})
+        _validate_index(request, request["data"]["type"])
 
         # Offload creation
         # Creation subfunction must be async
@@ -456,10 +476,12 @@ class StellarStellar():
         Update a field's parameters. The possibilities vary based on field type, so offloaded
         to a factory function.
         Most types actually don't have update options.
+        Every non-entity field can be (un)indexed by passing "index" in the data, see index_field.
         """
         field_sc = self.STELLAR[request["schema"]].entities[request["entity"]].fields[request["data"]["code"]]
         if field_sc.type not in self._field_factory["update"]:
             raise NotImplementedError
+        _validate_index(request, field_sc.type)
 
         # Offload update
         # Update subfunction must be async
@@ -469,6 +491,95 @@ class StellarStellar():
         return comet or Comet(schema=request["schema"], entity=request["entity"])
 
 
+    async def index_field(self, db_pool, request):
+        """
+        Build, rebuild or drop the index of a field, as requested by a field create/update request's
+        "index" data:
+            {"method": "btree"|"hash", "partial": <bool>, "unique": <bool>} to build, "partial" only indexes unarchived records,
+            "unique" rejects duplicates (btree only) and lets the field identify records in upserts
+            null/false to drop
+        This needs to run once the request is committed, outside of any transaction, as indexes
+        are built concurrently to keep the table writable. Progress is recorded in the field's
+        params["index"]["status"] (building|ready|failed), and indexed is only set once ready.
+
+        :param PSQL db_pool: physical DB of the field
+        :param dict request: committed field create/update request
+        """
+        field_sc = self.STELLAR[request["schema"]].entities[request["entity"]].fields[request["data"]["code"]]
+        table = self.STELLAR[request["schema"]].entities[request["entity"]].code
+        index = request["data"]["index"]
+
+        await self._record_index(request, index and (index | {"status": "building"}), False)
+        try:
+            async with db_pool.stage() as db:
+                await db.set_autocommit(True)
+                try:
+                    await db.drop_index(table, field_sc.code)
+                    if index:
+                        await db.create_index(table, field_sc.code, index["method"], index["partial"], index["unique"])
+                finally:
+                    await db.set_autocommit(False)
+        except Exception as e:
+            print(f"Index build failed on {table}.{field_sc.code}: {e}")  # TODO log
+            await self._record_index(request, index and (index | {"status": "failed"}), False)
+            return
+        await self._record_index(request, index and (index | {"status": "ready"}), bool(index))
+
+
+    async def index_relations(self, db_pool, schema):
+        """
+        One-shot maintenance: create the missing indexes of every relation table of a schema.
+        Relation tables created before Stellar indexed them on creation have none, see
+        _PSQLConnection.index_relation_table. Built concurrently, so the tables stay writable.
+
+        :param PSQL db_pool: physical DB of the schema
+        :param str schema: schema to index
+        """
+        relations = {}
+        for entity in self.STELLAR[schema].entities.values():
+            for field in entity.fields.values():
+                if field.type not in ("ENTITY", "MULTIENTITY"):
+                    continue
+                for constraint in field.params["constraints"].values():
+                    relations[constraint["relation"]] = (entity.code, constraint["table"])
+        async with db_pool.stage() as db:
+            await db.set_autocommit(True)
+            try:
+                for relation, (table, ftable) in relations.items():
+                    try:
+                        await db.index_relation_table(relation, table, ftable, concurrently=True)
+                    except Exception as e:
+                        # Keep going, a failed build can be retried by running this again
+                        print(f"Indexing {relation} failed: {e}")  # TODO log
+            finally:
+                await db.set_autocommit(False)
+
+
+    async def _record_index(self, request, index, indexed):
+        """
+        Record the index state of a field in Stellar, and shoot for the stars.
+
+        :param dict request: field create/update request
+        :param dict index: index state to record in the field's params, None if there's no index
+        :param bool indexed: if the index is built and usable
+        """
+        field_sc = self.STELLAR[request["schema"]].entities[request["entity"]].fields[request["data"]["code"]]
+        params = {key: value for key, value in (field_sc.params or {}).items() if key != "index"}
+        if index:
+            params["index"] = index
+        async with self.database.stage() as stellardb:
+            await stellardb.update({
+                "table": "fields",
+                "entity": "Field",
+                "entity_id": field_sc.id,
+                "data": {
+                    "indexed": indexed,
+                    "params": Jsonb(params)
+                }
+            })
+        await self.shoot_for_the_stars(Comet(schema=request["schema"], entity=request["entity"]))
+
+
     async def delete_field(self, request, db, stellardb):
         """
         Archive a field, or delete it if it's already archived.
@@ -842,6 +953,67 @@ class StellarStellar():
         await _create_stellar_field_relation(f_id, self.STELLAR[request["schema"]].entities[request["entity"]].id, stellardb)
 
 
+    async def _field_create_search(self, request, db, stellardb):
+        """
+        Search fields are full-text search documents (tsvector) the DB keeps up to date by itself
+        from other text fields of the same entity. They can't be written to, only filtered on
+        with the "matches" filter operation and sorted by relevance. See COMPLETE_USAGE.
+        Creating a search field involves the following:
+            - Create physical generated field: DB
+            - Create field record: Stellar
+        Its fulltext index is built by index_field, like any other index.
+
+        Search field creation requires the additional "data/options" key in the request:
+        {
+            "part": "field",
+            "request_type": "create",
+            "schema": <schema_code>,
+            "entity": <entity_code>,
+            "data": {
+                "code": <field_code>,
+                "name": <field_name>,
+                "type": "SEARCH"
+
+                "options": {
+                    "fields": [<TEXT or LIST field codes to search through>],
+                    "language": <text search configuration, OPTIONAL, default "simple">
+                }
+            }
+        }
+
+        :param dict request: the field creation request
+        :param db._database.Database db: the physical DB connection
+
+        :raises: AssertionError if the source fields aren't text fields of the entity
+        """
+        entity_sc = self.STELLAR[request["schema"]].entities[request["entity"]]
+        options = request["data"].get("options", {})
+        assert options.get("fields")
+        for source in options["fields"]:
+            assert source in entity_sc.fields and entity_sc.fields[source].type in ("TEXT", "LIST")
+        language = options.get("language") or "simple"
+
+        # Create field
+        await db.create_search_field(entity_sc.code, request["data"]["code"], options["fields"], language)
+
+        # Create Stellar record
+        SF_OP = {
+            "table": "fields",
+            "entity": "Field",
+            "data": {
+                "code": request["data"]["code"],
+                "name": request["data"]["name"],
+                "field_type": "SEARCH",
+                "indexed": False,
+                "params": Jsonb({"fields": options["fields"], "language": language})
+            }
+        }
+        f_id = (await stellardb.create(SF_OP))["uid"]
+
+        # Create Stellar relation
+        await _create_stellar_field_relation(f_id, entity_sc.id, stellardb)
+
+
     async def _field_create_entity(self, request, db, stellardb):
         """
         Creating an entity link is the most convoluted process of all. Thanks SQL.
@@ -883,26 +1055,9 @@ class StellarStellar():
         table_sc = self.STELLAR[request["schema"]].entities[request["entity"]]
         for ftype in request["data"]["options"]:
             ftable = self.STELLAR[request["schema"]].entities[ftype].code
-            # Create relation table
+            # Create relation table, indexed both ways
             tab = REL_TABLE.format(table=table_sc.code, ftable=ftable)
-            REL_TABLE_COMMAND = sql.SQL("""
-                CREATE TABLE IF NOT EXISTS {relation} (
-                    {table_col} TEXT NOT NULL,
-                    {fk_table} INT NOT NULL REFERENCES {table} (uid) ON DELETE CASCADE,
-                    uid INT GENERATED ALWAYS AS IDENTITY,
-                    {fk_ftable} INT NOT NULL REFERENCES {ftable} (uid) ON DELETE CASCADE,
-                    {ftable_col} TEXT NOT NULL
-                );
-            """).format(
-                relation=sql.Identifier(tab),
-                table_col=sql.Identifier(table_sc.code+"_col"),
-                fk_table=sql.Identifier("fk_"+table_sc.code),
-                table=sql.Identifier(table_sc.code),
-                fk_ftable=sql.Identifier("fk_"+ftable),
-                ftable=sql.Identifier(ftable),
-                ftable_col=sql.Identifier(ftable+"_col")
-            )
-            await db.execute(REL_TABLE_COMMAND)  # Reminder, this is a non-standard table
+            await db.create_relation_table(tab, table_sc.code, ftable)
 
             # Create foreign field record
             FF_PARAMS = {
@@ -1069,26 +1224,9 @@ class StellarStellar():
                 # Field link already defined, skip it.
                 continue
             ftable = self.STELLAR[request["schema"]].entities[ftype].code
-            # Create relation table
+            # Create relation table, indexed both ways
             tab = REL_TABLE.format(table=table_sc.code, ftable=ftable)
-            REL_TABLE_COMMAND = sql.SQL("""
-                CREATE TABLE IF NOT EXISTS {relation} (
-                    {table_col} TEXT NOT NULL,
-                    {fk_table} INT NOT NULL REFERENCES {table} (uid) ON DELETE CASCADE,
-                    uid INT GENERATED ALWAYS AS IDENTITY,
-                    {fk_ftable} INT NOT NULL REFERENCES {ftable} (uid) ON DELETE CASCADE,
-                    {ftable_col} TEXT NOT NULL
-                );
-            """).format(
-                relation=sql.Identifier(tab),
-                table_col=sql.Identifier(table_sc.code+"_col"),
-                fk_table=sql.Identifier("fk_"+table_sc.code),
-                table=sql.Identifier(table_sc.code),
-                fk_ftable=sql.Identifier("fk_"+ftable),
-                ftable=sql.Identifier(ftable),
-                ftable_col=sql.Identifier(ftable+"_col")
-            )
-            await db.execute(REL_TABLE_COMMAND)
+            await db.create_relation_table(tab, table_sc.code, ftable)
 
             # Create foreign field record
             FF_PARAMS = {
@@ -1168,7 +1306,16 @@ class StellarStellar():
 
         :param dict request: field deletion request
         :param db._database.Database db: physical DB connection
+
+        :raises: AssertionError if a SEARCH field is generated from this one
         """
+        # The DB won't drop a column a SEARCH field is generated from, the SEARCH field has to go first
+        searched_by = [
+            field.code for field in self.STELLAR[request["schema"]].entities[request["entity"]].fields.values()
+            if field.type == "SEARCH" and request["data"]["code"] in (field.params or {}).get("fields", [])
+        ]
+        assert not searched_by, "Field %s is searched by %s, delete those first" % (request["data"]["code"], ", ".join(searched_by))
+
         # Delete physical column
         await db.delete_field(self.STELLAR[request["schema"]].entities[request["entity"]].code, request["data"]["code"])
 
@@ -1305,6 +1452,31 @@ class StellarStellar():
 # DURATION -> maybe
 # FILE/LINK -> maybe
 # PERCENTAGE -> maybe
+def _validate_index(request, field_type):
+    """
+    Validate and normalize the "index" data of a field create/update request, if any.
+
+    :param dict request: field create/update request
+    :param str field_type: type of the field
+
+    :raises: AssertionError if the field can't be indexed this way
+    """
+    if not request["data"].get("index"):
+        return
+    index = request["data"]["index"]
+    # Entity fields live in relation tables, which are indexed by Stellar itself
+    assert field_type not in ("ENTITY", "MULTIENTITY")
+    assert isinstance(index, dict) and index.get("method", "btree") in PSQL.INDEX_METHODS
+    assert field_type in PSQL.INDEX_METHOD_TYPES.get(index.get("method", "btree"), (field_type,))
+    # Only btree indexes can be unique
+    assert not index.get("unique") or index.get("method", "btree") == "btree"
+    request["data"]["index"] = {
+        "method": index.get("method", "btree"),
+        "partial": bool(index.get("partial", False)),
+        "unique": bool(index.get("unique", False))
+    }
+
+
 async def _create_stellar_field_relation(f_id, e_id, stellardb):
     """
     Simple function to generate a stellar field relation, since it's done all over.
@@ -0,0 +1,82 @@
+"""
+Small in-process caches used to skip repeated work on hot read paths.
+Everything in here is owned by STELLAR and thrown away whenever a comet says the schema changed.
+"""
+from time import monotonic
+
+
+class ReadPlanCache(dict):
+    """
+    Compiled read plans, keyed by read shape:
+    (schema, entity, normalized return fields, order, filter shape, ...)
+
+    The schema code is always the first element of the key so plans can be dropped per schema.
+    Plans hold finished SQL text only, never values, so they are safe to share between callers.
+    """
+    MAX_PLANS = 512
+
+    def __setitem__(self, key, plan):
+        if key not in self and len(self) >= self.MAX_PLANS:
+            # Evict the oldest plan. Hot shapes get recompiled on their next call anyway.
+            self.pop(next(iter(self)), None)
+        super().__setitem__(key, plan)
+
+    def invalidate(self, schema=None):
+        """
+        Drop compiled plans. Called by STELLAR whenever a comet lands.
+
+        :param str schema: only drop plans of this schema, default drops everything
+        """
+        if schema is None:
+            self.clear()
+            return
+        # Snapshot the keys, comets are handled from the listener thread
+        for key in [key for key in list(self) if key[0] == schema]:
+            self.pop(key, None)
+
+
+class CountCache(dict):
+    """
+    Record counts of reads, keyed by (schema, tables read, count SQL, bound values, table versions).
+
+    Entries expire after a TTL. The table versions are shared by every instance through Redis
+    (see src.modules.railcache), so a write on any instance makes the counts of its tables miss
+    everywhere. This instance also drops them right away to free up the space.
+    """
+    MAX_COUNTS = 4096
+
+    def __setitem__(self, key, count):
+        if key not in self and len(self) >= self.MAX_COUNTS:
+            self.pop(next(iter(self)), None)
+        super().__setitem__(key, (monotonic(), count))
+
+    def fresh(self, key, ttl):
+        """
+        Fetch a count, unless it's older than the TTL.
+
+        :param tuple key: count key
+        :param int ttl: seconds a count stays valid
+
+        :returns: the cached count, None if there's none or it expired
+        :rtype: dict|None
+        """
+        counted = self.get(key)
+        if counted is None:
+            return None
+        if monotonic() - counted[0] > ttl:
+            self.pop(key, None)
+            return None
+        return counted[1]
+
+    def invalidate(self, schema=None, tables=None):
+        """
+        Drop counts. Called by STELLAR whenever a comet lands, and by Railgun after writes.
+
+        :param str schema: only drop counts of this schema, default drops everything
+        :param set tables: only drop counts reading from any of these tables, default drops the whole schema
+        """
+        if schema is None:
+            self.clear()
+            return
+        for key in [key for key in list(self) if key[0] == schema and (tables is None or not tables.isdisjoint(key[1]))]:
+            self.pop(key, None)
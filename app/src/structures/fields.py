@@ -2,6 +2,7 @@ import bcrypt
 from pathlib import Path
 
 from config import CONFIG
+from db._database import CUDError
 from src.structures.returnfields import ReturnField, EntityReturnField, PresetReturnField, MultiEntityReturnField
 
 
@@ -134,9 +135,17 @@ class MultiEntity_Field(Simple_Field):
 
     def middleware(self, op):
         # we presume that the value being used for data is correct
+        links = op["data"].pop(self.code)
+        if isinstance(links, dict):
+            # Only the links given change, see Railgun._update
+            return {
+                "sf": self,
+                "add": links.get("add") or [],
+                "remove": links.get("remove") or []
+            }
         return {
             "sf": self,
-            "data": op["data"].pop(self.code) or []  # [] in case set to None
+            "data": links or []  # [] in case set to None
         }
 
 
@@ -181,6 +190,12 @@ class Media_Field(Simple_Field):
             file[0].unlink()
 
 
+class Search_Field(Simple_Field):
+    def middleware(self, op):
+        # Generated by the DB from its source fields, see _PSQLConnection.create_search_field
+        raise CUDError("SEARCH field %s is kept up to date from %s, it can't be set" % (self.code, ", ".join(self.params["fields"])))
+
+
 FIELD_TYPES = {
     "default": Simple_Field,
     "ENTITY": Entity_Field,
@@ -188,5 +203,6 @@ FIELD_TYPES = {
     "LIST": List_Field,
     "PASSWORD": Password_Field,
     "BOOL": Bool_Field,
-    "MEDIA": Media_Field
+    "MEDIA": Media_Field,
+    "SEARCH": Search_Field
 }
@@ -114,6 +114,23 @@ CREATE TABLE _ss_users_permission_rules (
     permission_rules_col TEXT NOT NULL
 );
 
+-- RELATION INDEXES --
+-- One per direction, see _PSQLConnection.index_relation_table
+CREATE INDEX _ss_rel_entities__ss_entities_schemas_eed9836dea8c ON _ss_entities_schemas (fk_entities, entities_col) INCLUDE (fk_schemas);
+CREATE INDEX _ss_rel_schemas__ss_entities_schemas_f7e07b3960aa ON _ss_entities_schemas (fk_schemas, schemas_col) INCLUDE (fk_entities);
+CREATE INDEX _ss_rel_fields__ss_fields_entities_ce785e4a96f7 ON _ss_fields_entities (fk_fields, fields_col) INCLUDE (fk_entities);
+CREATE INDEX _ss_rel_entities__ss_fields_entities_c1256ae5ffef ON _ss_fields_entities (fk_entities, entities_col) INCLUDE (fk_fields);
+CREATE INDEX _ss_rel_pages__ss_pages_page_settings_5ee3e322cb08 ON _ss_pages_page_settings (fk_pages, pages_col) INCLUDE (fk_page_settings);
+CREATE INDEX _ss_rel_page_settings__ss_pages_page_settings_9878885ba7db ON _ss_pages_page_settings (fk_page_settings, page_settings_col) INCLUDE (fk_pages);
+CREATE INDEX _ss_rel_page_settings__ss_page_settings_entities_62007d91ae54 ON _ss_page_settings_entities (fk_page_settings, page_settings_col) INCLUDE (fk_entities);
+CREATE INDEX _ss_rel_entities__ss_page_settings_entities_ea914eaab809 ON _ss_page_settings_entities (fk_entities, entities_col) INCLUDE (fk_page_settings);
+CREATE INDEX _ss_rel_page_settings__ss_page_settings_fields_8079ef329d3c ON _ss_page_settings_fields (fk_page_settings, page_settings_col) INCLUDE (fk_fields);
+CREATE INDEX _ss_rel_fields__ss_page_settings_fields_c8b8c97f09d4 ON _ss_page_settings_fields (fk_fields, fields_col) INCLUDE (fk_page_settings);
+CREATE INDEX _ss_rel_permission_rules__ss_permission_rules_enti_f2283ecec96a ON _ss_permission_rules_entities (fk_permission_rules, permission_rules_col) INCLUDE (fk_entities);
+CREATE INDEX _ss_rel_entities__ss_permission_rules_entities_3fb202695308 ON _ss_permission_rules_entities (fk_entities, entities_col) INCLUDE (fk_permission_rules);
+CREATE INDEX _ss_rel_users__ss_users_permission_rules_6e9932e04aea ON _ss_users_permission_rules (fk_users, users_col) INCLUDE (fk_permission_rules);
+CREATE INDEX _ss_rel_permission_rules__ss_users_permission_rule_d6563f5e5f94 ON _ss_users_permission_rules (fk_permission_rules, permission_rules_col) INCLUDE (fk_users);
+
 -- SCHEMAS --
 INSERT INTO schemas (code, name, host, db_type) VALUES ('railgun_internal', 'Railgun Internal', 'stellardb', 'PSQL');
 INSERT INTO schemas (code, name, host, db_type) VALUES ('archive', 'Archive', 'archive', 'PSQL');